@@ -23,11 +23,17 @@ from app.llms import (
     get_openai_llm,
 )
 from app.retrieval import get_retrieval_executor
-from psycopg_pool import AsyncConnectionPool
 from app.checkpoint import (
-    PostgresCheckpoint, PickleCheckpointSerializer
+    DEFAULT_CACHE_MAX_BYTES,
+    DEFAULT_FLUSH_INTERVAL,
+    DEFAULT_SNAPSHOT_INTERVAL,
+    MAX_TRACKED_THREADS,
+    PostgresCheckpoint,
+    VersionedCheckpointSerializer,
 )
 import os
+from app.lifespan import on_shutdown
+from app.maintenance import use_checkpointer
 from app.tools import (
     RETRIEVAL_DESCRIPTION,
     TOOLS,
@@ -118,18 +124,34 @@ DEFAULT_SYSTEM_MESSAGE = """
 - Initialization: 欢迎使用社区智能助手，我是你的开源社区专家。如果你有任何关于openGauss社区的问题，请随时提问，我会尽力为你提供帮助。
 """
 
-async_pool = AsyncConnectionPool(
-    # Example configuration
-    conninfo="postgresql://{}:{}@{}:{}/{}".format(os.environ["POSTGRES_USER"],
-        os.environ["POSTGRES_PASSWORD"], os.environ["POSTGRES_HOST"],
-        os.environ["POSTGRES_PORT"], os.environ["POSTGRES_DB"]),
-    max_size=20,
-)
-
 CHECKPOINTER = PostgresCheckpoint(
-    serial=PickleCheckpointSerializer(),
-    async_conn=async_pool,
+    serial=VersionedCheckpointSerializer(
+        compression=os.environ.get("CHECKPOINT_COMPRESSION"),
+        format=os.environ.get("CHECKPOINT_FORMAT", "pickle"),
+    ),
+    storage_mode=os.environ.get("CHECKPOINT_STORAGE_MODE", "full"),
+    snapshot_interval=int(
+        os.environ.get("CHECKPOINT_SNAPSHOT_INTERVAL", DEFAULT_SNAPSHOT_INTERVAL)
+    ),
+    cache_max_entries=int(
+        os.environ.get("CHECKPOINT_CACHE_MAX_ENTRIES", MAX_TRACKED_THREADS)
+    ),
+    cache_max_bytes=int(
+        os.environ.get("CHECKPOINT_CACHE_MAX_BYTES", DEFAULT_CACHE_MAX_BYTES)
+    ),
+    # Costs a query per cache hit; only needed when more than one process
+    # (e.g. several uvicorn workers or replicas) runs the same threads.
+    validate_cache=os.environ.get("CHECKPOINT_CACHE_VALIDATE", "false").lower()
+    == "true",
+    write_behind=os.environ.get("CHECKPOINT_WRITE_BEHIND", "false").lower() == "true",
+    flush_interval=float(
+        os.environ.get("CHECKPOINT_FLUSH_INTERVAL", DEFAULT_FLUSH_INTERVAL)
+    ),
+    message_store=os.environ.get("CHECKPOINT_MESSAGE_STORE", "false").lower()
+    == "true",
 )
+on_shutdown(CHECKPOINTER.aflush)
+use_checkpointer(CHECKPOINTER)
 
 
 def get_agent_executor(
@@ -1,8 +1,9 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException
 
 from app.api.assistants import router as assistants_router
 from app.api.runs import router as runs_router
 from app.api.threads import router as threads_router
+from app.lifespan import get_pg_pool, get_pg_replica_pool
 
 router = APIRouter()
 
@@ -12,6 +13,20 @@ async def ok():
     return {"ok": True}
 
 
+@router.get("/stats/pool")
+async def pool_stats():
+    """Use of this worker's database connection pool."""
+    return get_pg_pool().stats()
+
+
+@router.get("/stats/pool/replica")
+async def replica_pool_stats():
+    """Use of this worker's read replica connection pool."""
+    if (pool := get_pg_replica_pool()) is None:
+        raise HTTPException(status_code=404, detail="No read replica configured")
+    return pool.stats()
+
+
 router.include_router(
     assistants_router,
     prefix="/assistants",
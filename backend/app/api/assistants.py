@@ -1,13 +1,14 @@
-from typing import Annotated, List
+from typing import Annotated, List, Optional, Union
 from uuid import uuid4
 
-from fastapi import APIRouter, HTTPException, Path, Request
+from fastapi import APIRouter, HTTPException, Path, Query, Request, Response
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel, Field
 
 import app.storage as storage
+from app.api.pagination import PageCursor, PageLimit, decode_cursor, set_next_cursor
 from app.auth.handlers import AuthedUser
-from app.schema import Assistant
+from app.schema import Assistant, AssistantSummary
 from app.agent import DEFAULT_SYSTEM_MESSAGE
 import structlog
 from datetime import datetime, timezone
@@ -21,21 +22,53 @@ class AssistantPayload(BaseModel):
     name: str = Field(..., description="The name of the assistant.")
     config: dict = Field(..., description="The assistant config.")
     public: bool = Field(default=False, description="Whether the assistant is public.")
+    template_id: Optional[str] = Field(
+        default=None,
+        description="The template to base the config on. "
+        "When updating, defaults to the template of the assistant.",
+    )
 
 
 AssistantID = Annotated[str, Path(description="The ID of the assistant.")]
 
+IncludeConfig = Annotated[
+    bool,
+    Query(description="Whether to return the config of each assistant."),
+]
+
 
 @router.get("/")
-async def list_assistants(user: AuthedUser) -> List[Assistant]:
-    """List all assistants for the current user."""
-    return await storage.list_assistants(user["user_id"])
+async def list_assistants(
+    user: AuthedUser,
+    response: Response,
+    limit: PageLimit = None,
+    cursor: PageCursor = None,
+    include_config: IncludeConfig = True,
+) -> List[Union[Assistant, AssistantSummary]]:
+    """List the assistants of the current user, most recently updated first."""
+    assistants = await storage.list_assistants(
+        user["user_id"],
+        limit=limit,
+        before=decode_cursor(cursor),
+        include_config=include_config,
+    )
+    set_next_cursor(response, assistants, limit, "assistant_id")
+    return assistants
 
 
 @router.get("/public/")
-async def list_public_assistants() -> List[Assistant]:
-    """List all public assistants."""
-    return await storage.list_public_assistants()
+async def list_public_assistants(
+    response: Response,
+    limit: PageLimit = None,
+    cursor: PageCursor = None,
+    include_config: IncludeConfig = True,
+) -> List[Union[Assistant, AssistantSummary]]:
+    """List the public assistants, most recently updated first."""
+    assistants = await storage.list_public_assistants(
+        limit=limit, before=decode_cursor(cursor), include_config=include_config
+    )
+    set_next_cursor(response, assistants, limit, "assistant_id")
+    return assistants
 
 
 @router.get("/{aid}")
@@ -62,6 +95,7 @@ async def create_assistant(
         name=payload.name,
         config=payload.config,
         public=payload.public,
+        template_id=payload.template_id,
     )
 
 
@@ -72,12 +106,18 @@ async def upsert_assistant(
     payload: AssistantPayload,
 ) -> Assistant:
     """Create or update an assistant."""
+    template_id = payload.template_id
+    if template_id is None and (
+        existing := await storage.get_assistant(user["user_id"], aid)
+    ):
+        template_id = existing["template_id"]
     return await storage.put_assistant(
         user["user_id"],
         aid,
         name=payload.name,
         config=payload.config,
         public=payload.public,
+        template_id=template_id,
     )
 
 
@@ -90,15 +130,9 @@ async def delete_assistant(
     await storage.delete_assistant(user["user_id"], aid)
     return {"status": "ok"}
 
-async def _create_default_assistant(user_id: str, name: str) -> Assistant:
-    """create default assistant"""
-    # 复用 gitee_name 作为 assistant 的name
-    assistant_name = 'default_opengauss'
-    self_info = ""
-    if name:
-        assistant_name = name
-        self_info = "我的gitee_name为:" + name
-    default_config = {
+def _default_config(self_info: str = "") -> dict:
+    """default assistant config"""
+    return {
         "configurable":{
             "type":"agent",
             "type==agent/agent_type":"GPT 3.5 Turbo",
@@ -287,12 +321,25 @@ async def _create_default_assistant(user_id: str, name: str) -> Assistant:
             "type==chat_retrieval/system_message":DEFAULT_SYSTEM_MESSAGE + self_info
         }
     }
+
+async def _create_default_assistant(user_id: str, name: str) -> Assistant:
+    """create default assistant"""
+    # 复用 gitee_name 作为 assistant 的name
+    assistant_name = 'default_opengauss'
+    self_info = ""
+    if name:
+        assistant_name = name
+        self_info = "我的gitee_name为:" + name
+    # The config is shared by all default assistants, only the system
+    # messages differ.
+    template_id = await storage.put_assistant_template(_default_config())
     return await storage.put_assistant(
         user_id,
         str(uuid4()),
         name=assistant_name,
-        config=default_config,
+        config=_default_config(self_info),
         public=False,
+        template_id=template_id,
     )
 
 @router.post("/getorcreate")
@@ -317,7 +364,10 @@ async def create_assistant(request: Request) -> Assistant:
                 return await _create_default_assistant(user['user_id'], payload['gitee_name'])
             return assistants[0] 
     except Exception as e:
-        await storage.delete_user(user["sub"], user["user_id"])
+        if is_first:
+            # Only undo what this request created: deleting a user also
+            # deletes their threads and assistants.
+            await storage.delete_user(user["sub"], user["user_id"])
         logger.info("Exception: {}".format(e))
         return JSONResponse(status_code=400, content={"message": "get or create default assistant failed."})
 
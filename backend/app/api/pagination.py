@@ -0,0 +1,53 @@
+"""Keyset pagination for list endpoints."""
+
+import base64
+from datetime import datetime
+from typing import Annotated, Any, Optional, Sequence
+
+from fastapi import HTTPException, Query, Response
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+PageLimit = Annotated[
+    Optional[int],
+    Query(
+        ge=1,
+        le=1000,
+        description="The maximum number of items to return. "
+        "All items are returned if not set.",
+    ),
+]
+
+PageCursor = Annotated[
+    Optional[str],
+    Query(
+        description=f"Return the page after this cursor, taken from the "
+        f"{NEXT_CURSOR_HEADER} header of the previous page.",
+    ),
+]
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[tuple[datetime, str]]:
+    """Decode a cursor into the `(updated_at, id)` of the last item of a page."""
+    if cursor is None:
+        return None
+    try:
+        updated_at, id_ = (
+            base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+        )
+        return datetime.fromisoformat(updated_at), id_
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def set_next_cursor(
+    response: Response, items: Sequence[Any], limit: Optional[int], id_key: str
+) -> None:
+    """Set the cursor of the next page on the response, if this page is full."""
+    if limit is None or len(items) < limit:
+        return
+    last = items[-1]
+    cursor = f"{last['updated_at'].isoformat()}|{last[id_key]}"
+    response.headers[NEXT_CURSOR_HEADER] = base64.urlsafe_b64encode(
+        cursor.encode()
+    ).decode()
@@ -1,8 +1,8 @@
-from typing import Any, Dict, Optional, Sequence, Union
-from uuid import UUID
+from typing import Any, AsyncIterator, Dict, Optional, Sequence, Union
+from uuid import UUID, uuid4
 
 import langsmith.client
-from fastapi import APIRouter, BackgroundTasks, HTTPException
+from fastapi import APIRouter, BackgroundTasks, Header, HTTPException, Query
 from fastapi.exceptions import RequestValidationError
 from langchain.pydantic_v1 import ValidationError
 from langchain_core.messages import AnyMessage
@@ -11,10 +11,10 @@ from langsmith.utils import tracing_is_enabled
 from pydantic import BaseModel, Field
 from sse_starlette import EventSourceResponse
 
-from app.agent import agent
+from app.agent import CHECKPOINTER, agent
 from app.auth.handlers import AuthedUser
-from app.storage import get_assistant, get_thread
-from app.stream import astream_state, to_sse
+from app.storage import get_thread_and_assistant
+from app.stream import RunStream, astream_state, coalesce, get_run_stream, to_sse
 
 router = APIRouter()
 
@@ -30,16 +30,17 @@ class CreateRunPayload(BaseModel):
 
 
 async def _run_input_and_config(payload: CreateRunPayload, user_id: str):
-    thread = await get_thread(user_id, payload.thread_id)
+    thread, assistant = await get_thread_and_assistant(user_id, payload.thread_id)
     if not thread:
         raise HTTPException(status_code=404, detail="Thread not found")
-
-    assistant = await get_assistant(user_id, str(thread["assistant_id"]))
     if not assistant:
         raise HTTPException(status_code=404, detail="Assistant not found")
 
+    # The run id is also stored with the run's checkpoints.
+    run_id = uuid4()
     config: RunnableConfig = {
         **assistant["config"],
+        "run_id": run_id,
         "configurable": {
             **assistant["config"]["configurable"],
             **((payload.config or {}).get("configurable") or {}),
@@ -47,6 +48,7 @@ async def _run_input_and_config(payload: CreateRunPayload, user_id: str):
             "thread_id": str(thread["thread_id"]),
             "assistant_id": str(assistant["assistant_id"]),
             "assistant_name": str(assistant["name"]),
+            "run_id": str(run_id),
         },
     }
 
@@ -59,6 +61,37 @@ async def _run_input_and_config(payload: CreateRunPayload, user_id: str):
     return payload.input, config
 
 
+async def _mark_interrupt(config: RunnableConfig) -> None:
+    """Record the checkpoint a finished run stopped at, if it waits for input."""
+    configurable = {
+        key: value
+        for key, value in config["configurable"].items()
+        if key != "thread_ts"
+    }
+    state = await agent.aget_state({**config, "configurable": configurable})
+    # Another run may have continued the thread since.
+    if state.next and (state.metadata or {}).get("run_id") == configurable["run_id"]:
+        await CHECKPOINTER.amark_interrupt(state.config)
+
+
+async def _invoke(input_, config: RunnableConfig) -> None:
+    try:
+        await agent.ainvoke(input_, config)
+    finally:
+        await CHECKPOINTER.aflush(config["configurable"]["thread_id"])
+    await _mark_interrupt(config)
+
+
+async def _finish_after(stream: AsyncIterator, config: RunnableConfig) -> AsyncIterator:
+    """Make the run's checkpoints durable before the stream ends."""
+    try:
+        async for chunk in stream:
+            yield chunk
+    finally:
+        await CHECKPOINTER.aflush(config["configurable"]["thread_id"])
+    await _mark_interrupt(config)
+
+
 @router.post("")
 async def create_run(
     payload: CreateRunPayload,
@@ -67,14 +100,21 @@ async def create_run(
 ):
     """Create a run."""
     input_, config = await _run_input_and_config(payload, user["user_id"])
-    background_tasks.add_task(agent.ainvoke, input_, config)
-    return {"status": "ok"}  # TODO add a run id
+    background_tasks.add_task(_invoke, input_, config)
+    return {"status": "ok", "run_id": config["configurable"]["run_id"]}
 
 
 @router.post("/stream")
 async def stream_run(
     payload: CreateRunPayload,
     user: AuthedUser,
+    deltas: bool = Query(
+        False,
+        description="Stream the tokens of a message as `delta` events, which "
+        "only hold the new content with the message id, instead of `data` "
+        "events with the whole message so far. The complete message is still "
+        "sent as a `data` event when it is done.",
+    ),
 ):
     """Create a run."""
     input_, config = await _run_input_and_config(payload, user["user_id"])
@@ -83,7 +123,41 @@ async def stream_run(
     #     input_[0].content = " ".join([input_[0].content, addition])
     # print(config)
 
-    return EventSourceResponse(to_sse(astream_state(agent, input_, config)))
+    run_stream = RunStream(
+        config["configurable"]["run_id"],
+        user["user_id"],
+        to_sse(
+            coalesce(
+                _finish_after(
+                    astream_state(agent, input_, config, deltas=deltas), config
+                )
+            )
+        ),
+    )
+    return EventSourceResponse(run_stream.subscribe())
+
+
+@router.get("/{run_id}/stream")
+async def resume_stream(
+    run_id: str,
+    user: AuthedUser,
+    last_event_id: Optional[str] = Header(
+        None, description="The id of the last event received, 0 to start over."
+    ),
+):
+    """Reconnect to the stream of a run, from after the last event received.
+
+    Only works on the worker that started the run, and until shortly after
+    the run ended.
+    """
+    run_stream = get_run_stream(run_id)
+    if run_stream is None or run_stream.user_id != user["user_id"]:
+        raise HTTPException(status_code=404, detail="Run not found")
+    try:
+        after = int(last_event_id or 0)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid Last-Event-ID")
+    return EventSourceResponse(run_stream.subscribe(after))
 
 
 @router.get("/input_schema")
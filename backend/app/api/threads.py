@@ -1,11 +1,14 @@
+from datetime import datetime
 from typing import Annotated, Any, Dict, List, Optional, Sequence, Union
+from urllib.parse import quote
 from uuid import uuid4
 
-from fastapi import APIRouter, HTTPException, Path
+from fastapi import APIRouter, Header, HTTPException, Path, Query, Response
 from langchain.schema.messages import AnyMessage
 from pydantic import BaseModel, Field
 
 import app.storage as storage
+from app.api.pagination import PageCursor, PageLimit, decode_cursor, set_next_cursor
 from app.auth.handlers import AuthedUser
 from app.schema import Thread
 
@@ -29,28 +32,81 @@ class ThreadPostRequest(BaseModel):
     config: Optional[Dict[str, Any]] = None
 
 
+class ThreadForkRequest(BaseModel):
+    """Payload for forking a thread."""
+
+    thread_ts: Optional[datetime] = Field(
+        None,
+        description="The thread_ts of the state to fork from. "
+        "Defaults to the latest state.",
+    )
+    name: Optional[str] = Field(
+        None,
+        description="The name of the new thread. Defaults to the name of the "
+        "thread being forked.",
+    )
+
+
 @router.get("/")
-async def list_threads(user: AuthedUser) -> List[Thread]:
-    """List all threads for the current user."""
-    return await storage.list_threads(user["user_id"])
+async def list_threads(
+    user: AuthedUser,
+    response: Response,
+    limit: PageLimit = None,
+    cursor: PageCursor = None,
+) -> List[Thread]:
+    """List the threads of the current user, most recently updated first."""
+    threads = await storage.list_threads(
+        user["user_id"], limit=limit, before=decode_cursor(cursor)
+    )
+    set_next_cursor(response, threads, limit, "thread_id")
+    return threads
+
+
+def _etag_matches(etag: str, if_none_match: Optional[str]) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag in tags or "*" in tags
 
 
 @router.get("/{tid}/state")
 async def get_thread_state(
     user: AuthedUser,
     tid: ThreadID,
+    response: Response,
+    after: Optional[str] = Query(
+        None,
+        description="Only return the messages after the message with this ID. "
+        "All messages are returned if there is no such message.",
+    ),
+    limit: Optional[int] = Query(
+        None, ge=1, description="Only return the last messages, at most this many."
+    ),
+    if_none_match: Optional[str] = Header(None),
 ):
-    """Get state for a thread."""
-    thread = await storage.get_thread(user["user_id"], tid)
+    """Get state for a thread.
+
+    The ETag of the response changes with the state and the projection, pass
+    it in If-None-Match to get a 304 response while the state is unchanged.
+    """
+    thread, assistant = await storage.get_thread_and_assistant(user["user_id"], tid)
     if not thread:
         raise HTTPException(status_code=404, detail="Thread not found")
-    assistant = await storage.get_assistant(user["user_id"], thread["assistant_id"])
     if not assistant:
         raise HTTPException(status_code=400, detail="Thread has no assistant")
+    version = await storage.get_thread_state_version(tid)
+    if version is not None:
+        # Message IDs are arbitrary strings, quote them to keep the tag valid.
+        etag = f'"{version}-{quote(after or "", safe="")}-{limit or ""}"'
+        if _etag_matches(etag, if_none_match):
+            return Response(status_code=304, headers={"ETag": etag})
+        response.headers["ETag"] = etag
     return await storage.get_thread_state(
         user_id=user["user_id"],
         thread_id=tid,
         assistant=assistant,
+        message_limit=limit,
+        after_message_id=after,
     )
 
 
@@ -61,10 +117,9 @@ async def add_thread_state(
     payload: ThreadPostRequest,
 ):
     """Add state to a thread."""
-    thread = await storage.get_thread(user["user_id"], tid)
+    thread, assistant = await storage.get_thread_and_assistant(user["user_id"], tid)
     if not thread:
         raise HTTPException(status_code=404, detail="Thread not found")
-    assistant = await storage.get_assistant(user["user_id"], thread["assistant_id"])
     if not assistant:
         raise HTTPException(status_code=400, detail="Thread has no assistant")
     return await storage.update_thread_state(
@@ -79,18 +134,33 @@ async def add_thread_state(
 async def get_thread_history(
     user: AuthedUser,
     tid: ThreadID,
+    limit: Optional[int] = Query(
+        None, ge=1, description="The maximum number of states to return."
+    ),
+    before: Optional[datetime] = Query(
+        None,
+        description="Only return states older than this thread_ts. Pass the "
+        "thread_ts of the last state of a page to get the next one.",
+    ),
+    summary: bool = Query(
+        False,
+        description="Return thread_ts, parent_ts, message count and size of "
+        "each state instead of its values.",
+    ),
 ):
-    """Get all past states for a thread."""
-    thread = await storage.get_thread(user["user_id"], tid)
+    """Get past states for a thread, newest first."""
+    thread, assistant = await storage.get_thread_and_assistant(user["user_id"], tid)
     if not thread:
         raise HTTPException(status_code=404, detail="Thread not found")
-    assistant = await storage.get_assistant(user["user_id"], thread["assistant_id"])
     if not assistant:
         raise HTTPException(status_code=400, detail="Thread has no assistant")
     return await storage.get_thread_history(
         user_id=user["user_id"],
         thread_id=tid,
         assistant=assistant,
+        limit=limit,
+        before=before,
+        summary=summary,
     )
 
 
@@ -135,6 +205,24 @@ async def upsert_thread(
     )
 
 
+@router.post("/{tid}/fork")
+async def fork_thread(
+    user: AuthedUser,
+    tid: ThreadID,
+    payload: ThreadForkRequest,
+) -> Thread:
+    """Create a new thread that starts from a state of this thread."""
+    try:
+        thread = await storage.fork_thread(
+            user["user_id"], tid, thread_ts=payload.thread_ts, name=payload.name
+        )
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Thread state not found")
+    if not thread:
+        raise HTTPException(status_code=404, detail="Thread not found")
+    return thread
+
+
 @router.delete("/{tid}")
 async def delete_thread(
     user: AuthedUser,
@@ -0,0 +1,123 @@
+"""In-process caches."""
+import time
+from collections import OrderedDict
+from typing import Generic, Hashable, Optional, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    """A least-recently-used cache bounded by entry count and total size.
+
+    The size of an entry is given by the caller when it is stored, in whatever
+    unit `max_bytes` is expressed in.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: Optional[int] = None) -> None:
+        if max_entries < 1:
+            raise ValueError("max_entries must be a positive integer.")
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[K, tuple[V, int]] = OrderedDict()
+        self._bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: K) -> bool:
+        return key in self._entries
+
+    @property
+    def size(self) -> int:
+        """Total size of the cached entries."""
+        return self._bytes
+
+    def peek(self, key: K) -> Optional[V]:
+        """Return the entry for `key`, without counting it as a hit or miss."""
+        if key in self._entries:
+            return self._entries[key][0]
+        return None
+
+    def get(self, key: K) -> Optional[V]:
+        """Return the entry for `key` and mark it as recently used."""
+        if key not in self._entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return self._entries[key][0]
+
+    def put(self, key: K, value: V, size: int = 0) -> None:
+        """Store `value` under `key`, evicting old entries to stay in bounds.
+
+        Values larger than `max_bytes` on their own are not stored.
+        """
+        self.pop(key)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        self._entries[key] = (value, size)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or (
+            self.max_bytes is not None and self._bytes > self.max_bytes
+        ):
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+
+    def pop(self, key: K) -> Optional[V]:
+        """Remove and return the entry for `key`, if any."""
+        if key not in self._entries:
+            return None
+        value, size = self._entries.pop(key)
+        self._bytes -= size
+        return value
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class TTLCache(Generic[K, V]):
+    """An `LRUCache` whose entries also expire `ttl_seconds` after being stored."""
+
+    def __init__(
+        self, max_entries: int, ttl_seconds: float, max_bytes: Optional[int] = None
+    ) -> None:
+        if ttl_seconds <= 0:
+            raise ValueError("ttl_seconds must be positive.")
+        self.ttl_seconds = ttl_seconds
+        self._lru: LRUCache[K, tuple[V, float]] = LRUCache(max_entries, max_bytes)
+
+    def __len__(self) -> int:
+        return len(self._lru)
+
+    def get(self, key: K) -> Optional[V]:
+        """Return the entry for `key` if it has not expired."""
+        entry = self._lru.peek(key)
+        if entry is not None and entry[1] <= time.monotonic():
+            self._lru.pop(key)
+        entry = self._lru.get(key)
+        return None if entry is None else entry[0]
+
+    def put(self, key: K, value: V, size: int = 0) -> None:
+        self._lru.put(key, (value, time.monotonic() + self.ttl_seconds), size)
+
+    def pop(self, key: K) -> Optional[V]:
+        entry = self._lru.pop(key)
+        return None if entry is None else entry[0]
+
+    def clear(self) -> None:
+        self._lru.clear()
+
+    def stats(self) -> dict[str, int]:
+        return self._lru.stats()
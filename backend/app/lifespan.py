@@ -1,18 +1,166 @@
+import asyncio
 import os
 from contextlib import asynccontextmanager
+from functools import partial
+from typing import Awaitable, Callable, Optional
 
 import asyncpg
 import orjson
 import structlog
 from fastapi import FastAPI
 
-_pg_pool = None
+from app.cache import TTLCache
+from app.maintenance import maintenance
+from app.pool import InstrumentedPool, create_pool
 
+logger = structlog.get_logger(__name__)
 
-def get_pg_pool() -> asyncpg.pool.Pool:
+_pg_pool: Optional[InstrumentedPool] = None
+_pg_replica_pool: Optional[InstrumentedPool] = None
+
+
+def _optional_float(name: str) -> Optional[float]:
+    value = os.environ.get(name)
+    return float(value) if value else None
+
+
+def _server_settings(value: str) -> dict[str, str]:
+    """Parse `name=value` pairs separated by commas."""
+    return dict(item.strip().split("=", 1) for item in value.split(",") if item.strip())
+
+
+# Connection budget per worker. Everything that talks to Postgres, including
+# the checkpointer, shares the asyncpg pool; only the vector store, which is
+# built on SQLAlchemy, keeps a small pool of its own.
+PG_POOL_MIN_SIZE = int(os.environ.get("POSTGRES_POOL_MIN_SIZE", 2))
+PG_POOL_MAX_SIZE = int(os.environ.get("POSTGRES_POOL_MAX_SIZE", 10))
+VECTORSTORE_POOL_SIZE = int(os.environ.get("POSTGRES_VECTORSTORE_POOL_SIZE", 2))
+# Seconds to wait for a pool connection, unset to wait forever.
+PG_POOL_ACQUIRE_TIMEOUT = _optional_float("POSTGRES_POOL_ACQUIRE_TIMEOUT")
+# Prepared statements kept per connection; 0 when behind a transaction pooler.
+PG_STATEMENT_CACHE_SIZE = int(os.environ.get("POSTGRES_STATEMENT_CACHE_SIZE", 100))
+# Default seconds a statement on a pool connection may run, unset for no limit.
+PG_COMMAND_TIMEOUT = _optional_float("POSTGRES_COMMAND_TIMEOUT")
+# Session settings of every connection, e.g. "jit=off,work_mem=8MB". The JIT
+# only costs planning time on the short statements of this app.
+PG_SERVER_SETTINGS = _server_settings(
+    os.environ.get("POSTGRES_SERVER_SETTINGS", "jit=off")
+)
+# An optional hot standby to send read-only queries to.
+PG_REPLICA_HOST = os.environ.get("POSTGRES_REPLICA_HOST")
+PG_REPLICA_PORT = os.environ.get("POSTGRES_REPLICA_PORT")
+PG_REPLICA_POOL_MAX_SIZE = int(
+    os.environ.get("POSTGRES_REPLICA_POOL_MAX_SIZE", PG_POOL_MAX_SIZE)
+)
+# Seconds to keep reading a row from the primary after it was written, so that
+# the replica can catch up. Should exceed the replication lag.
+PG_REPLICA_READ_YOUR_WRITES_SECONDS = float(
+    os.environ.get("POSTGRES_REPLICA_READ_YOUR_WRITES_SECONDS", 10)
+)
+# Seconds to wait before reconnecting the LISTEN connection.
+NOTIFY_RECONNECT_SECONDS = float(os.environ.get("POSTGRES_NOTIFY_RECONNECT_SECONDS", 5))
+
+
+def get_pg_pool() -> InstrumentedPool:
     return _pg_pool
 
 
+def get_pg_replica_pool() -> Optional[InstrumentedPool]:
+    return _pg_replica_pool
+
+
+# Keys written recently, None standing for all of them.
+_recent_writes: TTLCache[Optional[str], bool] = TTLCache(
+    100_000, PG_REPLICA_READ_YOUR_WRITES_SECONDS
+)
+
+
+def mark_written(key: Optional[str] = None) -> None:
+    """Read `key`, or everything if empty, from the primary for a while.
+
+    Keys are IDs of threads, assistants or users, whichever the reads ask for.
+    """
+    if _pg_replica_pool is not None:
+        _recent_writes.put(key or None, True)
+
+
+def get_pg_read_pool(key: Optional[str] = None) -> InstrumentedPool:
+    """The pool for a read-only query about `key`.
+
+    That is the replica pool if there is one, unless `key` was written
+    recently. Only writes made or notified to this worker are known, see
+    `mark_written`.
+    """
+    if _pg_replica_pool is None or _recent_writes.get(None):
+        return _pg_pool
+    if key and _recent_writes.get(key):
+        return _pg_pool
+    return _pg_replica_pool
+
+
+_shutdown_hooks: list[Callable[[], Awaitable[None]]] = []
+
+
+def on_shutdown(hook: Callable[[], Awaitable[None]]) -> None:
+    """Register a coroutine function to await before the pool is closed."""
+    _shutdown_hooks.append(hook)
+
+
+_notify_callbacks: dict[str, list[Callable[[Optional[str]], None]]] = {}
+
+
+def on_notify(channel: str, callback: Callable[[Optional[str]], None]) -> None:
+    """Register a function to call with the payload of each NOTIFY on `channel`.
+
+    Notifications are received on a dedicated connection, outside the pool.
+    The callback is called with None when notifications may have been missed,
+    on startup and after the connection was lost.
+    """
+    _notify_callbacks.setdefault(channel, []).append(callback)
+
+
+def _dispatch(
+    callbacks: list[Callable[[Optional[str]], None]],
+    conn: asyncpg.Connection,
+    pid: int,
+    channel: str,
+    payload: str,
+) -> None:
+    for callback in callbacks:
+        callback(payload)
+
+
+def _missed_notifications() -> None:
+    for callbacks in _notify_callbacks.values():
+        for callback in callbacks:
+            callback(None)
+
+
+async def _listen(connect: Callable[[], Awaitable[asyncpg.Connection]]) -> None:
+    """Deliver notifications to the registered callbacks, reconnecting as needed."""
+    while True:
+        try:
+            conn = await connect()
+        except (OSError, asyncpg.PostgresError):
+            logger.exception("Could not connect to listen for notifications")
+            await asyncio.sleep(NOTIFY_RECONNECT_SECONDS)
+            continue
+        lost = asyncio.Event()
+        conn.add_termination_listener(lambda _: lost.set())
+        try:
+            for channel, callbacks in _notify_callbacks.items():
+                await conn.add_listener(channel, partial(_dispatch, callbacks))
+            _missed_notifications()
+            await lost.wait()
+            logger.warning("Lost the connection listening for notifications")
+        except (OSError, asyncpg.PostgresError):
+            logger.exception("Listening for notifications failed")
+        finally:
+            conn.terminate()
+        _missed_notifications()
+        await asyncio.sleep(NOTIFY_RECONNECT_SECONDS)
+
+
 async def _init_connection(conn) -> None:
     await conn.set_type_codec(
         "json",
@@ -46,16 +194,47 @@ async def lifespan(app: FastAPI):
         cache_logger_on_first_use=True,
     )
 
-    global _pg_pool
+    global _pg_pool, _pg_replica_pool
 
-    _pg_pool = await asyncpg.create_pool(
+    connect_kwargs = dict(
         database=os.environ["POSTGRES_DB"],
         user=os.environ["POSTGRES_USER"],
         password=os.environ["POSTGRES_PASSWORD"],
         host=os.environ["POSTGRES_HOST"],
         port=os.environ["POSTGRES_PORT"],
+        server_settings=PG_SERVER_SETTINGS,
+    )
+    pool_kwargs = dict(
+        min_size=PG_POOL_MIN_SIZE,
+        acquire_timeout=PG_POOL_ACQUIRE_TIMEOUT,
+        statement_cache_size=PG_STATEMENT_CACHE_SIZE,
+        command_timeout=PG_COMMAND_TIMEOUT,
         init=_init_connection,
     )
-    yield
+    _pg_pool = await create_pool(
+        **connect_kwargs, **pool_kwargs, max_size=PG_POOL_MAX_SIZE
+    )
+    if PG_REPLICA_HOST:
+        _pg_replica_pool = await create_pool(
+            **{
+                **connect_kwargs,
+                "host": PG_REPLICA_HOST,
+                "port": PG_REPLICA_PORT or connect_kwargs["port"],
+            },
+            **pool_kwargs,
+            max_size=PG_REPLICA_POOL_MAX_SIZE,
+        )
+    listener = asyncio.create_task(_listen(partial(asyncpg.connect, **connect_kwargs)))
+    try:
+        async with maintenance(_pg_pool):
+            yield
+    finally:
+        listener.cancel()
+        await asyncio.gather(listener, return_exceptions=True)
+    for hook in _shutdown_hooks:
+        await hook()
+    if _pg_replica_pool is not None:
+        await _pg_replica_pool.close()
+        _pg_replica_pool = None
     await _pg_pool.close()
     _pg_pool = None
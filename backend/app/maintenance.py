@@ -0,0 +1,788 @@
+"""Background maintenance jobs for the checkpoints table.
+
+Every superstep of a run inserts a new checkpoint row and nothing else ever
+removes them. The jobs in this module keep the table bounded, and remove what
+deleted threads and assistants leave behind; they work in small batches so
+they can run next to live traffic.
+"""
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timedelta, timezone
+from functools import partial
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    NamedTuple,
+    Optional,
+)
+from uuid import UUID
+
+import asyncpg
+import structlog
+from pydantic import BaseSettings, validator
+
+if TYPE_CHECKING:
+    from app.checkpoint import PostgresCheckpoint
+
+logger = structlog.get_logger(__name__)
+
+_checkpointer: Optional["PostgresCheckpoint"] = None
+
+
+def use_checkpointer(checkpointer: "PostgresCheckpoint") -> None:
+    """Set the checkpointer for the jobs that need to decode checkpoints."""
+    global _checkpointer
+    _checkpointer = checkpointer
+
+
+class RetentionSettings(BaseSettings):
+    """Retention policy for checkpoints, configured from the environment."""
+
+    enabled: bool = False
+    """Whether to run compaction periodically in the background."""
+    keep_last: int = 20
+    """Number of most recent checkpoints to keep per thread."""
+    keep_interrupts: bool = True
+    """Keep the checkpoints a run stopped at to wait for input (e.g. tool
+    confirmation) that were never continued.
+
+    That is typically because the user edited an earlier message instead.
+    Runs record such checkpoints in their metadata, see
+    `PostgresCheckpoint.amark_interrupt`.
+    """
+    min_age_seconds: int = 3600
+    """Never delete checkpoints younger than this."""
+    batch_threads: int = 100
+    """Number of threads examined per batch."""
+    batch_rows: int = 5000
+    """Maximum number of rows deleted per statement."""
+    interval_seconds: int = 3600
+    """Pause between two compaction passes."""
+    batch_pause_seconds: float = 0.1
+    """Pause between two batches of a pass, to leave room for live traffic."""
+
+    @validator("keep_last")
+    def check_keep_last(cls, v):
+        if v < 1:
+            raise ValueError("keep_last must be at least 1.")
+        return v
+
+    class Config:
+        env_prefix = "checkpoint_retention_"
+
+
+class CompactionResult(NamedTuple):
+    threads: int
+    """Number of threads that were examined."""
+    deleted: int
+    """Number of checkpoint rows deleted."""
+    reclaimed_bytes: int
+    """Size of the checkpoint blobs that were deleted."""
+
+
+# Threads with more checkpoints than the policy keeps, in thread_id order.
+_COMPACTION_CANDIDATES_SQL = """
+SELECT thread_id
+FROM checkpoints
+WHERE thread_id > $1
+GROUP BY thread_id
+HAVING count(*) > $2
+ORDER BY thread_id
+LIMIT $3
+"""
+
+# Rows of the given threads that the policy does not keep. Besides the rows
+# the policy asks for, a kept delta row also keeps every row back to its
+# snapshot, since it can't be rebuilt without them, and rows that forked
+# threads were started from are kept too. This is evaluated once per
+# batch of threads: deleting rows leaves interrupts without children, which
+# must not change what the pass keeps.
+_COMPACTION_DOOMED_SQL = """
+WITH RECURSIVE ranked AS (
+    SELECT thread_id, thread_ts, parent_ts, is_snapshot, metadata,
+           row_number() OVER (PARTITION BY thread_id ORDER BY thread_ts DESC) AS rn
+    FROM checkpoints
+    WHERE thread_id = ANY($1::text[])
+),
+keep AS (
+    SELECT r.thread_id, r.thread_ts, r.parent_ts, r.is_snapshot
+    FROM ranked r
+    WHERE r.rn <= $2
+       OR r.thread_ts > now() - make_interval(secs => $3)
+       OR ($4 AND r.metadata @> '{"interrupt": true}' AND NOT EXISTS (
+            SELECT 1 FROM checkpoints child
+            WHERE child.thread_id = r.thread_id AND child.parent_ts = r.thread_ts
+       ))
+       OR EXISTS (
+            SELECT 1 FROM checkpoints fork
+            WHERE fork.source_thread_id = r.thread_id
+              AND fork.source_ts = r.thread_ts
+       )
+    UNION
+    SELECT c.thread_id, c.thread_ts, c.parent_ts, c.is_snapshot
+    FROM checkpoints c
+    JOIN keep ON c.thread_id = keep.thread_id AND c.thread_ts = keep.parent_ts
+    WHERE NOT keep.is_snapshot
+)
+SELECT r.thread_id, r.thread_ts
+FROM ranked r
+WHERE NOT EXISTS (
+    SELECT 1 FROM keep k
+    WHERE k.thread_id = r.thread_id AND k.thread_ts = r.thread_ts
+)
+"""
+
+_COMPACTION_DELETE_SQL = """
+DELETE FROM checkpoints c
+USING unnest($1::text[], $2::timestamptz[]) AS doomed (thread_id, thread_ts)
+WHERE c.thread_id = doomed.thread_id AND c.thread_ts = doomed.thread_ts
+RETURNING pg_column_size(c.checkpoint) AS size
+"""
+
+
+async def compact_checkpoints(
+    pool: asyncpg.Pool, settings: RetentionSettings
+) -> CompactionResult:
+    """Run one compaction pass over the checkpoints table.
+
+    Keeps the latest `keep_last` checkpoints of each thread, interrupts that
+    were never continued (if `keep_interrupts`), anything younger than
+    `min_age_seconds`, and whatever those need to be rebuilt. Everything else
+    is deleted, a batch of threads at a time.
+    """
+    cursor = ""
+    threads = deleted = reclaimed = 0
+    while True:
+        async with pool.acquire() as conn:
+            batch = await conn.fetch(
+                _COMPACTION_CANDIDATES_SQL,
+                cursor,
+                settings.keep_last,
+                settings.batch_threads,
+            )
+        if not batch:
+            break
+        thread_ids = [r["thread_id"] for r in batch]
+        cursor = thread_ids[-1]
+        threads += len(thread_ids)
+        async with pool.acquire() as conn:
+            doomed = await conn.fetch(
+                _COMPACTION_DOOMED_SQL,
+                thread_ids,
+                settings.keep_last,
+                float(settings.min_age_seconds),
+                settings.keep_interrupts,
+            )
+        for i in range(0, len(doomed), settings.batch_rows):
+            chunk = doomed[i : i + settings.batch_rows]
+            async with pool.acquire() as conn:
+                rows = await conn.fetch(
+                    _COMPACTION_DELETE_SQL,
+                    [r["thread_id"] for r in chunk],
+                    [r["thread_ts"] for r in chunk],
+                )
+            deleted += len(rows)
+            reclaimed += sum(r["size"] for r in rows)
+            await asyncio.sleep(settings.batch_pause_seconds)
+    result = CompactionResult(threads, deleted, reclaimed)
+    logger.info(
+        "Compacted checkpoints",
+        threads=result.threads,
+        deleted=result.deleted,
+        reclaimed_bytes=result.reclaimed_bytes,
+    )
+    return result
+
+
+class PartitionSettings(BaseSettings):
+    """Monthly partitioning of checkpoints, configured from the environment.
+
+    The checkpoints table is partitioned by hash of `thread_id`, and each hash
+    partition by range of `thread_ts` (see migration 000010). With `monthly`
+    set, a partition per month is created ahead of time under each hash
+    partition, so that old months can be detached or dropped at once instead
+    of deleted row by row.
+
+    Rows written before monthly partitions existed stay in the default
+    partitions, which are never retired.
+    """
+
+    monthly: bool = False
+    """Whether to manage monthly partitions in the background."""
+    months_ahead: int = 2
+    """Number of months, after the current one, to create partitions for."""
+    retain_months: Optional[int] = None
+    """Retire the partitions of months older than this, None to keep them.
+
+    This removes every checkpoint of those months, including the latest
+    checkpoint of threads that have been idle since. Newer delta rows that
+    build on them are rewritten as snapshots first, and a month that forks
+    were started from is kept until those forks are deleted.
+    """
+    drop_retired: bool = False
+    """Drop retired partitions rather than only detaching them.
+
+    Detached partitions are ordinary tables that can be archived or dropped
+    later.
+    """
+    interval_seconds: int = 86400
+    """Pause between two runs of the job."""
+
+    @validator("months_ahead")
+    def check_months_ahead(cls, v):
+        if v < 1:
+            raise ValueError("months_ahead must be at least 1.")
+        return v
+
+    @validator("retain_months")
+    def check_retain_months(cls, v):
+        if v is not None and v < 0:
+            raise ValueError("retain_months must not be negative.")
+        return v
+
+    class Config:
+        env_prefix = "checkpoint_partitions_"
+
+
+# The hash partitions of checkpoints, and their monthly partitions.
+_PARTITIONS_SQL = """
+SELECT parent.relname AS parent, child.relname AS name
+FROM pg_inherits hash_inh
+JOIN pg_class parent ON parent.oid = hash_inh.inhrelid
+LEFT JOIN pg_inherits month_inh ON month_inh.inhparent = parent.oid
+LEFT JOIN pg_class child ON child.oid = month_inh.inhrelid
+WHERE hash_inh.inhparent = 'checkpoints'::regclass AND parent.relkind = 'p'
+ORDER BY parent.relname, child.relname
+"""
+
+
+# Whether forks outside the given monthly partition were started from one of
+# its rows. Those rows can't be removed while the forks are read through them.
+_PARTITION_FORKED_SQL = """
+SELECT EXISTS (
+    SELECT 1
+    FROM "{name}" p
+    JOIN checkpoints fork
+      ON fork.source_thread_id = p.thread_id AND fork.source_ts = p.thread_ts
+    WHERE fork.thread_ts >= $1
+)
+"""
+
+_PARTITION_THREADS_SQL = 'SELECT DISTINCT thread_id FROM "{name}"'
+
+
+def _add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def _month_partition(parent: str, month: date) -> str:
+    return f"{parent}_{month:%Y_%m}"
+
+
+async def manage_partitions(
+    pool: asyncpg.Pool,
+    settings: PartitionSettings,
+    checkpointer: Optional["PostgresCheckpoint"] = None,
+) -> tuple[list[str], list[str]]:
+    """Create upcoming monthly partitions and retire expired ones.
+
+    Partitions are created from next month on: creating one checks that the
+    default partition holds no row of that month, which no longer holds once
+    the month has started.
+
+    Before a partition is retired, the threads it holds rows of are rebased
+    (see `PostgresCheckpoint.arebase_thread`), so that their later checkpoints
+    stay readable. A partition that forks were started from is skipped.
+
+    Args:
+        pool: The pool to run the statements on.
+        settings: The partitioning settings.
+        checkpointer: The checkpointer to rebase threads with, required if
+            `settings.retain_months` is set.
+
+    Returns:
+        The names of the created and of the retired partitions.
+    """
+    if settings.retain_months is not None and checkpointer is None:
+        raise ValueError("Retiring partitions requires a checkpointer.")
+    today = datetime.now(timezone.utc).date()
+    this_month = today.replace(day=1)
+    months = [_add_months(this_month, i) for i in range(1, settings.months_ahead + 1)]
+    cutoff = (
+        _add_months(this_month, -settings.retain_months)
+        if settings.retain_months is not None
+        else None
+    )
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(_PARTITIONS_SQL)
+    existing: dict[str, set[str]] = {}
+    for row in rows:
+        children = existing.setdefault(row["parent"], set())
+        if row["name"]:
+            children.add(row["name"])
+
+    created, retired = [], []
+    for parent, children in existing.items():
+        for month in months:
+            name = _month_partition(parent, month)
+            if name in children:
+                continue
+            async with pool.acquire() as conn:
+                await conn.execute(
+                    f'CREATE TABLE "{name}" PARTITION OF "{parent}" '
+                    f"FOR VALUES FROM ('{month.isoformat()}+00') "
+                    f"TO ('{_add_months(month, 1).isoformat()}+00')"
+                )
+            created.append(name)
+        if cutoff is None:
+            continue
+        for name in sorted(children):
+            suffix = name[len(parent) + 1 :]
+            try:
+                month = datetime.strptime(suffix, "%Y_%m").date()
+            except ValueError:
+                # The default partition.
+                continue
+            month_end = datetime.combine(
+                _add_months(month, 1), datetime.min.time(), timezone.utc
+            )
+            if month_end.date() > cutoff:
+                continue
+            async with pool.acquire() as conn:
+                if await conn.fetchval(
+                    _PARTITION_FORKED_SQL.format(name=name), month_end
+                ):
+                    logger.warning(
+                        "Not retiring checkpoint partition that forks refer to",
+                        partition=name,
+                    )
+                    continue
+                threads = await conn.fetch(_PARTITION_THREADS_SQL.format(name=name))
+            for row in threads:
+                await checkpointer.arebase_thread(row["thread_id"], month_end)
+            async with pool.acquire() as conn:
+                await conn.execute(f'ALTER TABLE "{parent}" DETACH PARTITION "{name}"')
+                if settings.drop_retired:
+                    await conn.execute(f'DROP TABLE "{name}"')
+            retired.append(name)
+    if created or retired:
+        logger.info("Managed checkpoint partitions", created=created, retired=retired)
+    return created, retired
+
+
+class ArchiveSettings(BaseSettings):
+    """Archival of idle threads, configured from the environment."""
+
+    enabled: bool = False
+    """Whether to archive idle threads periodically in the background."""
+    idle_seconds: int = 86400
+    """Archive threads without a new checkpoint for this long."""
+    batch_threads: int = 100
+    """Number of threads looked up per batch."""
+    interval_seconds: int = 3600
+    """Pause between two archival passes."""
+    batch_pause_seconds: float = 0.1
+    """Pause between two batches of a pass, to leave room for live traffic."""
+
+    class Config:
+        env_prefix = "checkpoint_archive_"
+
+
+# Idle threads with history left to archive, in thread_id order.
+_ARCHIVE_CANDIDATES_SQL = """
+SELECT thread_id
+FROM checkpoints
+WHERE thread_id > $1
+GROUP BY thread_id
+HAVING count(*) > 1 AND max(thread_ts) < $2
+ORDER BY thread_id
+LIMIT $3
+"""
+
+
+async def archive_idle_threads(
+    pool: asyncpg.Pool, checkpointer: "PostgresCheckpoint", settings: ArchiveSettings
+) -> tuple[int, int]:
+    """Run one archival pass over the checkpoints table.
+
+    Returns:
+        The number of threads archived and of checkpoints moved.
+    """
+    idle_since = datetime.now(timezone.utc) - timedelta(seconds=settings.idle_seconds)
+    cursor = ""
+    threads = archived = 0
+    while True:
+        async with pool.acquire() as conn:
+            batch = await conn.fetch(
+                _ARCHIVE_CANDIDATES_SQL, cursor, idle_since, settings.batch_threads
+            )
+        if not batch:
+            break
+        cursor = batch[-1]["thread_id"]
+        for row in batch:
+            if count := await checkpointer.aarchive_thread(
+                row["thread_id"], idle_since
+            ):
+                threads += 1
+                archived += count
+        await asyncio.sleep(settings.batch_pause_seconds)
+    logger.info("Archived idle threads", threads=threads, checkpoints=archived)
+    return threads, archived
+
+
+class GCSettings(BaseSettings):
+    """Cleanup after deleted threads and assistants, configured from the environment."""
+
+    enabled: bool = True
+    """Whether to work through the gc_queue periodically in the background."""
+    interval_seconds: int = 60
+    """Pause between two passes over the queue."""
+    batch_rows: int = 1000
+    """Maximum number of rows deleted per statement."""
+    batch_pause_seconds: float = 0.1
+    """Pause between two statements, to leave room for live traffic."""
+    reconcile: bool = False
+    """Whether to periodically queue data left behind before the queue existed,
+    or by deletions that bypassed it."""
+    reconcile_interval_seconds: int = 86400
+    """Pause between two searches for leftover data."""
+    min_orphan_age_seconds: int = 86400
+    """Never queue checkpoints younger than this, as a thread's first
+    checkpoint may be written before its row."""
+    sweep_messages: bool = False
+    """Whether to periodically delete stored messages that no checkpoint of
+    their thread refers to anymore, e.g. after compaction."""
+    sweep_interval_seconds: int = 86400
+    """Pause between two sweeps of the stored messages."""
+    sweep_idle_seconds: int = 86400
+    """Only sweep threads without a new checkpoint for this long."""
+
+    class Config:
+        env_prefix = "gc_"
+
+
+# Not locked: deleting an entry twice is harmless. Entries queued, or put
+# back, after the pass started are left for the next one.
+_GC_BATCH_SQL = """
+SELECT kind, id FROM gc_queue WHERE enqueued_at < $1 ORDER BY enqueued_at LIMIT $2
+"""
+
+_GC_DONE_SQL = "DELETE FROM gc_queue WHERE kind = $1 AND id = $2"
+
+_GC_RETRY_SQL = "UPDATE gc_queue SET enqueued_at = now() WHERE kind = $1 AND id = $2"
+
+_THREAD_EXISTS_SQL = "SELECT EXISTS (SELECT 1 FROM thread WHERE thread_id = $1)"
+
+_NAMESPACE_IN_USE_SQL = """
+SELECT EXISTS (SELECT 1 FROM assistant WHERE assistant_id = $1)
+    OR EXISTS (SELECT 1 FROM thread WHERE thread_id = $1)
+"""
+
+# Forked threads read the checkpoints, and stored messages, of their source.
+_FORKED_SQL = "SELECT EXISTS (SELECT 1 FROM checkpoints WHERE source_thread_id = $1)"
+
+_DELETE_MESSAGES_SQL = """
+DELETE FROM checkpoint_messages
+WHERE thread_id = $1 AND message_hash IN (
+    SELECT message_hash FROM checkpoint_messages WHERE thread_id = $1 LIMIT $2
+)
+"""
+
+# A single row per thread, deleted at once.
+_DELETE_ARCHIVE_SQL = "DELETE FROM checkpoints_archive WHERE thread_id = $1"
+
+# Deleted last: the reconciliation finds threads by their checkpoints.
+_DELETE_CHECKPOINTS_SQL = """
+DELETE FROM checkpoints
+WHERE thread_id = $1 AND thread_ts IN (
+    SELECT thread_ts FROM checkpoints WHERE thread_id = $1 LIMIT $2
+)
+"""
+
+_EMBEDDINGS_EXIST_SQL = "SELECT to_regclass('langchain_pg_embedding') IS NOT NULL"
+
+_DELETE_EMBEDDINGS_SQL = """
+DELETE FROM langchain_pg_embedding
+WHERE uuid IN (
+    SELECT uuid FROM langchain_pg_embedding
+    WHERE cmetadata @> jsonb_build_object('namespace', $1::text)
+    LIMIT $2
+)
+"""
+
+
+def _as_uuid(id_: str) -> Optional[str]:
+    """The ID as a UUID, or None if no thread or assistant can have it."""
+    try:
+        return str(UUID(id_))
+    except ValueError:
+        return None
+
+
+async def _delete_batches(
+    pool: asyncpg.Pool, sql: str, id_: str, settings: GCSettings
+) -> int:
+    """Run a `DELETE` taking `(id, limit)` until it deletes less than a batch."""
+    deleted = 0
+    while True:
+        async with pool.acquire() as conn:
+            status = await conn.execute(sql, id_, settings.batch_rows)
+        count = int(status.split()[-1])
+        deleted += count
+        await asyncio.sleep(settings.batch_pause_seconds)
+        if count < settings.batch_rows:
+            return deleted
+
+
+async def _collect_thread(
+    pool: asyncpg.Pool, thread_id: str, settings: GCSettings
+) -> tuple[int, bool]:
+    """Delete what a thread left behind.
+
+    Returns:
+        The number of rows deleted, and whether the thread is done with. It
+        is not while other threads are forked from it.
+    """
+    uuid = _as_uuid(thread_id)
+    async with pool.acquire() as conn:
+        if uuid is not None and await conn.fetchval(_THREAD_EXISTS_SQL, uuid):
+            # Created again with the same ID.
+            return 0, True
+        forked = await conn.fetchval(_FORKED_SQL, thread_id)
+    deleted = await _collect_namespace(pool, thread_id, settings)
+    if forked:
+        return deleted, False
+    deleted += await _delete_batches(pool, _DELETE_MESSAGES_SQL, thread_id, settings)
+    async with pool.acquire() as conn:
+        status = await conn.execute(_DELETE_ARCHIVE_SQL, thread_id)
+    deleted += int(status.split()[-1])
+    deleted += await _delete_batches(pool, _DELETE_CHECKPOINTS_SQL, thread_id, settings)
+    return deleted, True
+
+
+async def _collect_namespace(
+    pool: asyncpg.Pool, namespace: str, settings: GCSettings
+) -> int:
+    uuid = _as_uuid(namespace)
+    async with pool.acquire() as conn:
+        if uuid is not None and await conn.fetchval(_NAMESPACE_IN_USE_SQL, uuid):
+            return 0
+        if not await conn.fetchval(_EMBEDDINGS_EXIST_SQL):
+            return 0
+    return await _delete_batches(pool, _DELETE_EMBEDDINGS_SQL, namespace, settings)
+
+
+async def collect_garbage(pool: asyncpg.Pool, settings: GCSettings) -> tuple[int, int]:
+    """Delete what the threads and assistants in the gc_queue left behind.
+
+    Checkpoints of a thread that others were forked from are kept, and its
+    entry is put back at the end of the queue until the forks are gone.
+
+    Returns:
+        The number of queue entries done with and of rows deleted.
+    """
+    entries = deleted = 0
+    async with pool.acquire() as conn:
+        started = await conn.fetchval("SELECT now()")
+    while True:
+        async with pool.acquire() as conn:
+            batch = await conn.fetch(_GC_BATCH_SQL, started, 100)
+        if not batch:
+            break
+        for row in batch:
+            done = True
+            if row["kind"] == "thread":
+                count, done = await _collect_thread(pool, row["id"], settings)
+                deleted += count
+            elif row["kind"] == "namespace":
+                deleted += await _collect_namespace(pool, row["id"], settings)
+            else:
+                logger.warning("Unknown gc_queue entry", kind=row["kind"])
+            async with pool.acquire() as conn:
+                await conn.execute(
+                    _GC_DONE_SQL if done else _GC_RETRY_SQL, row["kind"], row["id"]
+                )
+            entries += done
+    if entries:
+        logger.info("Collected garbage", entries=entries, deleted=deleted)
+    return entries, deleted
+
+
+# Threads with stored messages, in thread_id order.
+_SWEEP_CANDIDATES_SQL = """
+SELECT DISTINCT thread_id
+FROM checkpoint_messages
+WHERE thread_id > $1
+ORDER BY thread_id
+LIMIT $2
+"""
+
+
+async def sweep_messages(
+    pool: asyncpg.Pool, checkpointer: "PostgresCheckpoint", settings: GCSettings
+) -> tuple[int, int]:
+    """Delete the stored messages that no checkpoint of their thread refers to.
+
+    Threads that are gone altogether are left to `collect_garbage`.
+
+    Returns:
+        The number of threads pruned and of messages deleted.
+    """
+    idle_since = datetime.now(timezone.utc) - timedelta(
+        seconds=settings.sweep_idle_seconds
+    )
+    cursor = ""
+    threads = deleted = 0
+    while True:
+        async with pool.acquire() as conn:
+            batch = await conn.fetch(_SWEEP_CANDIDATES_SQL, cursor, 100)
+        if not batch:
+            break
+        cursor = batch[-1]["thread_id"]
+        for row in batch:
+            if count := await checkpointer.aprune_messages(
+                row["thread_id"], idle_since
+            ):
+                threads += 1
+                deleted += count
+            await asyncio.sleep(settings.batch_pause_seconds)
+    logger.info("Swept stored messages", threads=threads, deleted=deleted)
+    return threads, deleted
+
+
+_ORPHAN_THREADS_SQL = """
+INSERT INTO gc_queue (kind, id)
+SELECT 'thread', c.thread_id
+FROM checkpoints c
+WHERE NOT EXISTS (SELECT 1 FROM thread t WHERE t.thread_id::text = c.thread_id)
+GROUP BY c.thread_id
+HAVING max(c.thread_ts) < now() - make_interval(secs => $1)
+ON CONFLICT DO NOTHING
+"""
+
+_ORPHAN_NAMESPACES_SQL = """
+INSERT INTO gc_queue (kind, id)
+SELECT DISTINCT 'namespace', e.cmetadata->>'namespace'
+FROM langchain_pg_embedding e
+WHERE e.cmetadata->>'namespace' <> 'public'
+  AND NOT EXISTS (
+    SELECT 1 FROM assistant a WHERE a.assistant_id::text = e.cmetadata->>'namespace'
+  )
+  AND NOT EXISTS (
+    SELECT 1 FROM thread t WHERE t.thread_id::text = e.cmetadata->>'namespace'
+  )
+ON CONFLICT DO NOTHING
+"""
+
+
+async def queue_orphans(pool: asyncpg.Pool, settings: GCSettings) -> int:
+    """Queue checkpoints and documents whose thread or assistant is gone.
+
+    Returns:
+        The number of entries added to the queue.
+    """
+    async with pool.acquire() as conn:
+        status = await conn.execute(
+            _ORPHAN_THREADS_SQL, float(settings.min_orphan_age_seconds)
+        )
+        queued = int(status.split()[-1])
+        if await conn.fetchval(_EMBEDDINGS_EXIST_SQL):
+            status = await conn.execute(_ORPHAN_NAMESPACES_SQL)
+            queued += int(status.split()[-1])
+    logger.info("Queued orphaned data", entries=queued)
+    return queued
+
+
+async def _run_periodically(
+    job: Callable[[], Awaitable[Any]], interval_seconds: float, name: str
+) -> None:
+    while True:
+        try:
+            await job()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception(f"{name} failed")
+        await asyncio.sleep(interval_seconds)
+
+
+@asynccontextmanager
+async def maintenance(pool: asyncpg.Pool) -> AsyncIterator[None]:
+    """Run the enabled maintenance jobs in the background while in context."""
+    tasks = []
+    retention = RetentionSettings()
+    if retention.enabled:
+        tasks.append(
+            asyncio.create_task(
+                _run_periodically(
+                    partial(compact_checkpoints, pool, retention),
+                    retention.interval_seconds,
+                    "Checkpoint compaction",
+                )
+            )
+        )
+    archive = ArchiveSettings()
+    if archive.enabled and _checkpointer is not None:
+        tasks.append(
+            asyncio.create_task(
+                _run_periodically(
+                    partial(archive_idle_threads, pool, _checkpointer, archive),
+                    archive.interval_seconds,
+                    "Checkpoint archival",
+                )
+            )
+        )
+    partitions = PartitionSettings()
+    if partitions.monthly and (
+        partitions.retain_months is None or _checkpointer is not None
+    ):
+        tasks.append(
+            asyncio.create_task(
+                _run_periodically(
+                    partial(manage_partitions, pool, partitions, _checkpointer),
+                    partitions.interval_seconds,
+                    "Checkpoint partition management",
+                )
+            )
+        )
+    gc = GCSettings()
+    if gc.enabled:
+        tasks.append(
+            asyncio.create_task(
+                _run_periodically(
+                    partial(collect_garbage, pool, gc),
+                    gc.interval_seconds,
+                    "Garbage collection",
+                )
+            )
+        )
+    if gc.sweep_messages and _checkpointer is not None:
+        tasks.append(
+            asyncio.create_task(
+                _run_periodically(
+                    partial(sweep_messages, pool, _checkpointer, gc),
+                    gc.sweep_interval_seconds,
+                    "Message sweep",
+                )
+            )
+        )
+    if gc.reconcile:
+        tasks.append(
+            asyncio.create_task(
+                _run_periodically(
+                    partial(queue_orphans, pool, gc),
+                    gc.reconcile_interval_seconds,
+                    "Orphan reconciliation",
+                )
+            )
+        )
+    try:
+        yield
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
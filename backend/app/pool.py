@@ -0,0 +1,133 @@
+"""The asyncpg connection pool, instrumented to show contention."""
+import asyncio
+import bisect
+import time
+from typing import Any, Generator, Optional
+
+import asyncpg
+
+# Upper bounds, in seconds, of the acquire latency histogram buckets.
+ACQUIRE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class InstrumentedPool:
+    """An asyncpg pool that records how long callers wait for a connection.
+
+    Wraps the pool, relying only on its public API. Also applies
+    `acquire_timeout` to acquisitions that don't give their own timeout,
+    including the ones made by `fetch` and friends. Other attributes are those
+    of the wrapped pool.
+    """
+
+    def __init__(self, pool: asyncpg.Pool, acquire_timeout: Optional[float]):
+        self.pool = pool
+        self.acquire_timeout = acquire_timeout
+        self._waiters = 0
+        self._acquires = 0
+        self._timeouts = 0
+        self._acquire_seconds = 0.0
+        self._buckets = [0] * (len(ACQUIRE_BUCKETS) + 1)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.pool, name)
+
+    def acquire(self, *, timeout: Optional[float] = None) -> "_AcquireContext":
+        """Like `asyncpg.Pool.acquire`, to await or use with `async with`."""
+        return _AcquireContext(self, timeout)
+
+    async def release(
+        self, connection: asyncpg.Connection, *, timeout: Optional[float] = None
+    ) -> None:
+        await self.pool.release(connection, timeout=timeout)
+
+    async def _acquire(self, timeout: Optional[float]) -> asyncpg.Connection:
+        if timeout is None:
+            timeout = self.acquire_timeout
+        self._waiters += 1
+        start = time.perf_counter()
+        try:
+            conn = await self.pool.acquire(timeout=timeout)
+        except asyncio.TimeoutError:
+            self._timeouts += 1
+            raise
+        finally:
+            self._waiters -= 1
+        elapsed = time.perf_counter() - start
+        self._acquires += 1
+        self._acquire_seconds += elapsed
+        self._buckets[bisect.bisect_left(ACQUIRE_BUCKETS, elapsed)] += 1
+        return conn
+
+    # The pool's own shortcuts would acquire past the instrumentation.
+    async def execute(self, *args: Any, **kwargs: Any) -> str:
+        async with self.acquire() as conn:
+            return await conn.execute(*args, **kwargs)
+
+    async def executemany(self, *args: Any, **kwargs: Any) -> None:
+        async with self.acquire() as conn:
+            return await conn.executemany(*args, **kwargs)
+
+    async def fetch(self, *args: Any, **kwargs: Any) -> list:
+        async with self.acquire() as conn:
+            return await conn.fetch(*args, **kwargs)
+
+    async def fetchrow(self, *args: Any, **kwargs: Any) -> Any:
+        async with self.acquire() as conn:
+            return await conn.fetchrow(*args, **kwargs)
+
+    async def fetchval(self, *args: Any, **kwargs: Any) -> Any:
+        async with self.acquire() as conn:
+            return await conn.fetchval(*args, **kwargs)
+
+    def stats(self) -> dict[str, Any]:
+        """Current use of the pool, and acquire latencies since it was created.
+
+        The histogram is cumulative: each bucket counts the acquisitions that
+        took at most that many seconds.
+        """
+        size = self.pool.get_size()
+        idle = self.pool.get_idle_size()
+        histogram = {}
+        count = 0
+        for bound, n in zip(ACQUIRE_BUCKETS + ("+Inf",), self._buckets):
+            count += n
+            histogram[str(bound)] = count
+        return {
+            "min_size": self.pool.get_min_size(),
+            "max_size": self.pool.get_max_size(),
+            "size": size,
+            "in_use": size - idle,
+            "idle": idle,
+            "waiters": self._waiters,
+            "acquires": self._acquires,
+            "acquire_timeouts": self._timeouts,
+            "acquire_seconds_sum": self._acquire_seconds,
+            "acquire_seconds": histogram,
+        }
+
+
+class _AcquireContext:
+    """What `InstrumentedPool.acquire` returns, as asyncpg's own."""
+
+    def __init__(self, pool: InstrumentedPool, timeout: Optional[float]):
+        self.pool = pool
+        self.timeout = timeout
+        self.connection: Optional[asyncpg.Connection] = None
+
+    async def __aenter__(self) -> asyncpg.Connection:
+        self.connection = await self.pool._acquire(self.timeout)
+        return self.connection
+
+    async def __aexit__(self, *exc: Any) -> None:
+        connection, self.connection = self.connection, None
+        await self.pool.release(connection)
+
+    def __await__(self) -> Generator[Any, None, asyncpg.Connection]:
+        return self.pool._acquire(self.timeout).__await__()
+
+
+async def create_pool(
+    *, acquire_timeout: Optional[float] = None, **kwargs: Any
+) -> InstrumentedPool:
+    """Like `asyncpg.create_pool`, for an `InstrumentedPool`."""
+    return InstrumentedPool(await asyncpg.create_pool(**kwargs), acquire_timeout)
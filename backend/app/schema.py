@@ -30,6 +30,21 @@ class Assistant(TypedDict):
     """Whether the assistant is public."""
 
 
+class AssistantSummary(TypedDict):
+    """Assistant model without the config, for list views."""
+
+    assistant_id: str
+    """The ID of the assistant."""
+    user_id: str
+    """The ID of the user that owns the assistant."""
+    name: str
+    """The name of the assistant."""
+    updated_at: datetime
+    """The last time the assistant was updated."""
+    public: bool
+    """Whether the assistant is public."""
+
+
 class Thread(TypedDict):
     thread_id: str
     """The ID of the thread."""
@@ -1,38 +1,351 @@
+import hashlib
+import os
 from datetime import datetime, timezone
-from typing import Any, List, Optional, Sequence, Union
+from typing import Any, Awaitable, Callable, List, Optional, Sequence, Union
+from uuid import uuid4
 
-from langchain_core.messages import AnyMessage
+import orjson
+from langchain_core.messages import AnyMessage, BaseMessage
 from langchain_core.runnables import RunnableConfig
 
-from app.agent import agent
-from app.lifespan import get_pg_pool
+from app.agent import CHECKPOINTER, agent
+from app.cache import TTLCache
+from app.checkpoint import CONFIG_KEY_MESSAGE_WINDOW
+from app.lifespan import get_pg_pool, get_pg_read_pool, mark_written, on_notify
 from app.schema import Assistant, Thread, User
 
+# Assistant and thread rows are looked up at the start of every request. They
+# are cached per worker, and dropped from every worker's cache when they change
+# (see the notify_row_change triggers). The TTL bounds how stale a row can get
+# if a notification is missed.
+LOOKUP_CACHE_MAX_ENTRIES = int(os.environ.get("LOOKUP_CACHE_MAX_ENTRIES", 10_000))
+LOOKUP_CACHE_TTL_SECONDS = float(os.environ.get("LOOKUP_CACHE_TTL_SECONDS", 60))
 
-async def list_assistants(user_id: str) -> List[Assistant]:
-    """List all assistants for the current user."""
-    async with get_pg_pool().acquire() as conn:
-        return await conn.fetch("SELECT * FROM assistant WHERE user_id = $1", user_id)
+
+class _LookupCache:
+    """Rows by ID, invalidated when the row changes."""
+
+    def __init__(self) -> None:
+        self.rows: TTLCache[str, Any] = TTLCache(
+            LOOKUP_CACHE_MAX_ENTRIES, LOOKUP_CACHE_TTL_SECONDS
+        )
+        # Bumped by every invalidation, to tell if a row read from the
+        # database may be stale by the time it is cached.
+        self.version = 0
+
+    def invalidate(self, key: Optional[str] = None) -> None:
+        """Drop the row for `key`, or all rows if `key` is empty.
+
+        Also reads the row from the primary for a while, as a replica may not
+        have the change yet.
+        """
+        self.version += 1
+        mark_written(key)
+        if key:
+            self.rows.pop(key)
+        else:
+            self.rows.clear()
+
+    def fill(self, key: str, row: Any, version: int) -> None:
+        """Cache a row read when the cache was at `version`."""
+        if row is not None and version == self.version:
+            self.rows.put(key, row)
+
+    async def get(self, key: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        if (row := self.rows.get(key)) is not None:
+            return row
+        version = self.version
+        row = await fetch()
+        self.fill(key, row, version)
+        return row
+
+
+_assistants = _LookupCache()
+_threads = _LookupCache()
+_users = _LookupCache()
+# Templates never change, see put_assistant_template.
+_templates = _LookupCache()
+on_notify("assistant_changed", _assistants.invalidate)
+on_notify("thread_changed", _threads.invalidate)
+on_notify("user_changed", _users.invalidate)
+
+
+# Statements are written once so that asyncpg's per-connection statement cache
+# prepares each of them only once per connection.
+_GET_ASSISTANT_SQL = "SELECT * FROM assistant WHERE assistant_id = $1"
+
+_GET_THREAD_SQL = "SELECT * FROM thread WHERE thread_id = $1"
+
+_ASSISTANT_COLUMNS = (
+    "assistant_id",
+    "user_id",
+    "name",
+    "config",
+    "updated_at",
+    "public",
+    "template_id",
+)
+
+# A thread and its assistant in one round trip. Like the other lookups, it reads
+# the rows regardless of the user, who is checked against the cached rows.
+_GET_THREAD_AND_ASSISTANT_SQL = f"""
+SELECT t.*, {", ".join(f"a.{c} AS a__{c}" for c in _ASSISTANT_COLUMNS)}
+FROM thread t
+LEFT JOIN assistant a ON a.assistant_id = t.assistant_id
+WHERE t.thread_id = $1
+"""
+
+_PUT_THREAD_SQL = """
+INSERT INTO thread (thread_id, user_id, assistant_id, name, updated_at, metadata)
+VALUES ($1, $2, $3, $4, $5, (
+    SELECT jsonb_build_object('assistant_type', coalesce(
+        a.config->'configurable'->>'type', t.config->'configurable'->>'type'
+    ))
+    FROM assistant a
+    LEFT JOIN assistant_template t ON t.template_id = a.template_id
+    WHERE a.assistant_id = $3 AND (a.user_id = $2 OR a.public IS true)
+))
+ON CONFLICT (thread_id) DO UPDATE SET
+    user_id = EXCLUDED.user_id,
+    assistant_id = EXCLUDED.assistant_id,
+    name = EXCLUDED.name,
+    updated_at = EXCLUDED.updated_at,
+    metadata = EXCLUDED.metadata
+RETURNING metadata
+"""
+
+
+# Columns of assistant list views that leave out the config.
+_ASSISTANT_SUMMARY_COLUMNS = (
+    "assistant_id, user_id, name, updated_at, public, template_id"
+)
+
+_GET_TEMPLATE_SQL = "SELECT config FROM assistant_template WHERE template_id = $1"
+
+_PUT_TEMPLATE_SQL = """
+INSERT INTO assistant_template (template_id, config)
+VALUES ($1, $2)
+ON CONFLICT (template_id) DO NOTHING
+"""
+
+
+# The user, and whether this statement created it. If another transaction
+# creates the user after this statement started, it returns no row.
+_GET_OR_CREATE_USER_SQL = """
+WITH created AS (
+    INSERT INTO "user" (sub) VALUES ($1)
+    ON CONFLICT (sub) DO NOTHING
+    RETURNING *
+)
+SELECT *, true AS created FROM created
+UNION ALL
+SELECT *, false AS created FROM "user"
+WHERE sub = $1 AND NOT EXISTS (SELECT 1 FROM created)
+"""
+
+
+def _merge_config(template: dict, overrides: dict) -> dict:
+    """Apply `overrides` to `template`, merging nested dicts."""
+    merged = dict(template)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = _merge_config(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def _config_overrides(template: dict, config: dict) -> Optional[dict]:
+    """The overrides that turn `template` into `config`.
+
+    Returns:
+        The overrides, or None if `config` lacks keys of `template`, which
+        overrides can't express.
+    """
+    overrides = {}
+    for key, value in config.items():
+        if key not in template:
+            overrides[key] = value
+        elif isinstance(value, dict) and isinstance(template[key], dict):
+            nested = _config_overrides(template[key], value)
+            if nested is None:
+                return None
+            if nested:
+                overrides[key] = nested
+        elif value != template[key]:
+            overrides[key] = value
+    if not template.keys() <= config.keys():
+        return None
+    return overrides
+
+
+async def _list_page(
+    sql: str,
+    args: list,
+    id_column: str,
+    *,
+    limit: Optional[int],
+    before: Optional[tuple[datetime, str]],
+    owner: Optional[str] = None,
+) -> list:
+    """Fetch a page of rows, newest first.
+
+    Args:
+        sql: A SELECT with a WHERE clause, to which the page bounds are added.
+        args: The arguments of `sql`.
+        id_column: The ID column that breaks ties between equal `updated_at`.
+        limit: The maximum number of rows to return.
+        before: Only return rows before this `(updated_at, id)`, the last row
+            of the previous page.
+        owner: The user whose rows are listed, read from the primary if they
+            changed one recently.
+    """
+    args = list(args)
+    if before is not None:
+        sql += f" AND (updated_at, {id_column}) < (${len(args) + 1}, ${len(args) + 2})"
+        args.extend(before)
+    sql += f" ORDER BY updated_at DESC, {id_column} DESC"
+    if limit is not None:
+        sql += f" LIMIT ${len(args) + 1}"
+        args.append(limit)
+    async with get_pg_read_pool(owner).acquire() as conn:
+        return await conn.fetch(sql, *args)
+
+
+def clear_caches() -> None:
+    """Drop all cached rows of this worker."""
+    for cache in (_assistants, _threads, _users, _templates):
+        cache.invalidate()
+
+
+def _can_read_assistant(assistant: Optional[Assistant], user_id: str) -> bool:
+    return bool(assistant) and (assistant["user_id"] == user_id or assistant["public"])
+
+
+def _can_read_thread(thread: Optional[Thread], user_id: str) -> bool:
+    return bool(thread) and thread["user_id"] == user_id
+
+
+async def _template_config(template_id: str) -> Optional[dict]:
+    async def fetch() -> Optional[dict]:
+        for pool in (get_pg_read_pool(), get_pg_pool()):
+            async with pool.acquire() as conn:
+                config = await conn.fetchval(_GET_TEMPLATE_SQL, template_id)
+            # A new template may not have reached the replica yet.
+            if config is not None:
+                return config
+
+    return await _templates.get(template_id, fetch)
+
+
+async def _resolve_assistant(row: Any) -> Assistant:
+    """Apply the config of an assistant to its template, if it has one."""
+    if row["template_id"] is None:
+        return row
+    template = await _template_config(row["template_id"])
+    return {**row, "config": _merge_config(template, row["config"])}
+
+
+async def _fetch_assistant(assistant_id: str) -> Optional[Assistant]:
+    async with get_pg_read_pool(assistant_id).acquire() as conn:
+        row = await conn.fetchrow(_GET_ASSISTANT_SQL, assistant_id)
+    return None if row is None else await _resolve_assistant(row)
+
+
+async def _fetch_thread(thread_id: str) -> Optional[Thread]:
+    async with get_pg_read_pool(thread_id).acquire() as conn:
+        return await conn.fetchrow(_GET_THREAD_SQL, thread_id)
+
+
+async def list_assistants(
+    user_id: str,
+    *,
+    limit: Optional[int] = None,
+    before: Optional[tuple[datetime, str]] = None,
+    include_config: bool = True,
+) -> List[Assistant]:
+    """List the assistants of the current user, most recently updated first.
+
+    Args:
+        user_id: The user ID.
+        limit: The maximum number of assistants to return.
+        before: Only return assistants before this `(updated_at, assistant_id)`.
+        include_config: Whether to return the config of each assistant.
+    """
+    columns = "*" if include_config else _ASSISTANT_SUMMARY_COLUMNS
+    rows = await _list_page(
+        f"SELECT {columns} FROM assistant WHERE user_id = $1",
+        [user_id],
+        "assistant_id",
+        limit=limit,
+        before=before,
+        owner=user_id,
+    )
+    if not include_config:
+        return rows
+    return [await _resolve_assistant(row) for row in rows]
 
 
 async def get_assistant(user_id: str, assistant_id: str) -> Optional[Assistant]:
     """Get an assistant by ID."""
-    async with get_pg_pool().acquire() as conn:
-        return await conn.fetchrow(
-            "SELECT * FROM assistant WHERE assistant_id = $1 AND (user_id = $2 OR public IS true)",
-            assistant_id,
-            user_id,
-        )
+    assistant = await _assistants.get(
+        assistant_id, lambda: _fetch_assistant(assistant_id)
+    )
+    return assistant if _can_read_assistant(assistant, user_id) else None
 
 
-async def list_public_assistants() -> List[Assistant]:
-    """List all the public assistants."""
-    async with get_pg_pool().acquire() as conn:
-        return await conn.fetch(("SELECT * FROM assistant WHERE public IS true;"))
+async def list_public_assistants(
+    *,
+    limit: Optional[int] = None,
+    before: Optional[tuple[datetime, str]] = None,
+    include_config: bool = True,
+) -> List[Assistant]:
+    """List the public assistants, most recently updated first.
+
+    Args:
+        limit: The maximum number of assistants to return.
+        before: Only return assistants before this `(updated_at, assistant_id)`.
+        include_config: Whether to return the config of each assistant.
+    """
+    columns = "*" if include_config else _ASSISTANT_SUMMARY_COLUMNS
+    rows = await _list_page(
+        f"SELECT {columns} FROM assistant WHERE public",
+        [],
+        "assistant_id",
+        limit=limit,
+        before=before,
+    )
+    if not include_config:
+        return rows
+    return [await _resolve_assistant(row) for row in rows]
+
+
+async def put_assistant_template(config: dict) -> str:
+    """Store an assistant config that assistants can share.
+
+    Templates are addressed by their content and never change.
+
+    Returns:
+        The template ID.
+    """
+    template_id = hashlib.blake2b(
+        orjson.dumps(config, option=orjson.OPT_SORT_KEYS), digest_size=16
+    ).hexdigest()
+    if _templates.rows.get(template_id) is None:
+        async with get_pg_pool().acquire() as conn:
+            await conn.execute(_PUT_TEMPLATE_SQL, template_id, config)
+        _templates.rows.put(template_id, config)
+    return template_id
 
 
 async def put_assistant(
-    user_id: str, assistant_id: str, *, name: str, config: dict, public: bool = False
+    user_id: str,
+    assistant_id: str,
+    *,
+    name: str,
+    config: dict,
+    public: bool = False,
+    template_id: Optional[str] = None,
 ) -> Assistant:
     """Modify an assistant.
 
@@ -42,30 +355,48 @@ async def put_assistant(
         name: The assistant name.
         config: The assistant config.
         public: Whether the assistant is public.
+        template_id: A template from `put_assistant_template` to base the
+            config on. Only the differences from it are stored. Ignored if the
+            config removes keys of the template.
 
     Returns:
         return the assistant model if no exception is raised.
     """
     updated_at = datetime.now(timezone.utc)
+    stored_config = config
+    if template_id is not None:
+        template = await _template_config(template_id)
+        if template is None:
+            raise ValueError(f"Unknown assistant template {template_id}.")
+        overrides = _config_overrides(template, config)
+        if overrides is None:
+            template_id = None
+        else:
+            stored_config = overrides
     async with get_pg_pool().acquire() as conn:
         async with conn.transaction():
             await conn.execute(
                 (
-                    "INSERT INTO assistant (assistant_id, user_id, name, config, updated_at, public) VALUES ($1, $2, $3, $4, $5, $6) "
+                    "INSERT INTO assistant (assistant_id, user_id, name, config, updated_at, public, template_id) VALUES ($1, $2, $3, $4, $5, $6, $7) "
                     "ON CONFLICT (assistant_id) DO UPDATE SET "
                     "user_id = EXCLUDED.user_id, "
                     "name = EXCLUDED.name, "
                     "config = EXCLUDED.config, "
                     "updated_at = EXCLUDED.updated_at, "
-                    "public = EXCLUDED.public;"
+                    "public = EXCLUDED.public, "
+                    "template_id = EXCLUDED.template_id;"
                 ),
                 assistant_id,
                 user_id,
                 name,
-                config,
+                stored_config,
                 updated_at,
                 public,
+                template_id,
             )
+    _assistants.invalidate(assistant_id)
+    # For the lists of the user's assistants.
+    mark_written(user_id)
     return {
         "assistant_id": assistant_id,
         "user_id": user_id,
@@ -73,6 +404,7 @@ async def put_assistant(
         "config": config,
         "updated_at": updated_at,
         "public": public,
+        "template_id": template_id,
     }
 
 
@@ -84,37 +416,170 @@ async def delete_assistant(user_id: str, assistant_id: str) -> None:
             assistant_id,
             user_id,
         )
+    _assistants.invalidate(assistant_id)
+    # Threads of the assistant lose their assistant_id.
+    _threads.invalidate()
 
 
-async def list_threads(user_id: str) -> List[Thread]:
-    """List all threads for the current user."""
-    async with get_pg_pool().acquire() as conn:
-        return await conn.fetch("SELECT * FROM thread WHERE user_id = $1 ORDER BY updated_at DESC", user_id)
+async def list_threads(
+    user_id: str,
+    *,
+    limit: Optional[int] = None,
+    before: Optional[tuple[datetime, str]] = None,
+) -> List[Thread]:
+    """List the threads of the current user, most recently updated first.
+
+    Args:
+        user_id: The user ID.
+        limit: The maximum number of threads to return.
+        before: Only return threads before this `(updated_at, thread_id)`.
+    """
+    return await _list_page(
+        "SELECT * FROM thread WHERE user_id = $1",
+        [user_id],
+        "thread_id",
+        limit=limit,
+        before=before,
+        owner=user_id,
+    )
 
 
 async def get_thread(user_id: str, thread_id: str) -> Optional[Thread]:
     """Get a thread by ID."""
-    async with get_pg_pool().acquire() as conn:
-        return await conn.fetchrow(
-            "SELECT * FROM thread WHERE thread_id = $1 AND user_id = $2",
-            thread_id,
-            user_id,
+    thread = await _threads.get(thread_id, lambda: _fetch_thread(thread_id))
+    return thread if _can_read_thread(thread, user_id) else None
+
+
+async def get_thread_and_assistant(
+    user_id: str, thread_id: str
+) -> tuple[Optional[Thread], Optional[Assistant]]:
+    """Get a thread and its assistant, with at most one query.
+
+    The config template of the assistant, if any, may take another.
+
+    Returns:
+        The thread, or None if the user can't read it, and its assistant, or
+        None if the thread has none or the user can't read it.
+    """
+    thread = _threads.rows.get(thread_id)
+    if thread is not None:
+        assistant = (
+            await _assistants.get(
+                thread["assistant_id"],
+                lambda: _fetch_assistant(thread["assistant_id"]),
+            )
+            if thread["assistant_id"]
+            else None
         )
+    else:
+        thread_version, assistant_version = _threads.version, _assistants.version
+        pool = get_pg_read_pool(thread_id)
+        async with pool.acquire() as conn:
+            row = await conn.fetchrow(_GET_THREAD_AND_ASSISTANT_SQL, thread_id)
+        if row is None:
+            return None, None
+        thread = {k: v for k, v in row.items() if not k.startswith("a__")}
+        _threads.fill(thread_id, thread, thread_version)
+        assistant = None
+        if row["a__assistant_id"] is not None and (
+            get_pg_read_pool(row["a__assistant_id"]) is not pool
+        ):
+            # The replica may have an old version of the assistant.
+            assistant = await _assistants.get(
+                row["a__assistant_id"],
+                lambda: _fetch_assistant(row["a__assistant_id"]),
+            )
+        elif row["a__assistant_id"] is not None:
+            assistant = await _resolve_assistant(
+                {c: row[f"a__{c}"] for c in _ASSISTANT_COLUMNS}
+            )
+            _assistants.fill(assistant["assistant_id"], assistant, assistant_version)
+    if not _can_read_thread(thread, user_id):
+        return None, None
+    return thread, assistant if _can_read_assistant(assistant, user_id) else None
 
 
-async def get_thread_state(*, user_id: str, thread_id: str, assistant: Assistant):
-    """Get state for a thread."""
-    state = await agent.aget_state(
-        {
-            "configurable": {
-                **assistant["config"]["configurable"],
-                "thread_id": thread_id,
-                "assistant_id": assistant["assistant_id"],
-            }
-        }
-    )
+# Messages loaded first when asked for the messages after a given one, which
+# is usually among the last few.
+_AFTER_MESSAGE_WINDOW = 32
+
+
+def _messages_after(values: Any, message_id: str) -> tuple[Any, bool]:
+    """Drop the messages up to the one with ID `message_id` from state values.
+
+    Returns:
+        The values, and whether the message was found.
+    """
+
+    def after(messages: list) -> tuple[list, bool]:
+        for i in range(len(messages) - 1, -1, -1):
+            if messages[i].id == message_id:
+                return messages[i + 1 :], True
+        return messages, False
+
+    def is_messages(value: Any) -> bool:
+        return isinstance(value, list) and all(
+            isinstance(m, BaseMessage) for m in value
+        )
+
+    if is_messages(values):
+        return after(values)
+    if isinstance(values, dict):
+        found = False
+        projected = {}
+        for key, value in values.items():
+            if is_messages(value):
+                value, found_here = after(value)
+                found = found or found_here
+            projected[key] = value
+        return projected, found
+    return values, False
+
+
+async def get_thread_state_version(thread_id: str) -> Optional[str]:
+    """An opaque version of the state of a thread, None if it has no state.
+
+    It changes whenever the state does, and is cheap to get: the state itself
+    is not loaded.
+    """
+    thread_ts = await CHECKPOINTER.alatest_ts(thread_id)
+    return None if thread_ts is None else thread_ts.isoformat()
+
+
+async def get_thread_state(
+    *,
+    user_id: str,
+    thread_id: str,
+    assistant: Assistant,
+    message_limit: Optional[int] = None,
+    after_message_id: Optional[str] = None,
+):
+    """Get state for a thread.
+
+    If `message_limit` is set, only the last `message_limit` messages are
+    loaded from the checkpoint. If `after_message_id` is set, only the messages
+    after that one are returned, or all of them if there is no such message.
+    """
+    configurable = {
+        **assistant["config"]["configurable"],
+        "thread_id": thread_id,
+        "assistant_id": assistant["assistant_id"],
+    }
+    if message_limit is not None:
+        configurable[CONFIG_KEY_MESSAGE_WINDOW] = message_limit
+    elif after_message_id is not None:
+        configurable[CONFIG_KEY_MESSAGE_WINDOW] = _AFTER_MESSAGE_WINDOW
+    state = await agent.aget_state({"configurable": configurable})
+    values = state.values
+    if after_message_id is not None:
+        values, found = _messages_after(values, after_message_id)
+        if not found and message_limit is None:
+            # Further back than the window, or gone.
+            del configurable[CONFIG_KEY_MESSAGE_WINDOW]
+            state = await agent.aget_state({"configurable": configurable})
+            values, _ = _messages_after(state.values, after_message_id)
     return {
-        "values": state.values,
+        "values": values,
         "next": state.next,
     }
 
@@ -137,10 +602,54 @@ async def update_thread_state(
         },
         values,
     )
+    await CHECKPOINTER.aflush(config["configurable"]["thread_id"])
 
 
-async def get_thread_history(*, user_id: str, thread_id: str, assistant: Assistant):
-    """Get the history of a thread."""
+async def get_thread_history(
+    *,
+    user_id: str,
+    thread_id: str,
+    assistant: Assistant,
+    limit: Optional[int] = None,
+    before: Optional[datetime] = None,
+    summary: bool = False,
+):
+    """Get the history of a thread, newest first.
+
+    Args:
+        user_id: The user ID.
+        thread_id: The thread ID.
+        assistant: The assistant of the thread.
+        limit: The maximum number of states to return.
+        before: Only return states older than this `thread_ts`, to page
+            through history.
+        summary: Return a summary of each state instead of its values.
+    """
+    config = {
+        "configurable": {
+            **assistant["config"]["configurable"],
+            "thread_id": thread_id,
+            "assistant_id": assistant["assistant_id"],
+        }
+    }
+    before_config = (
+        {"configurable": {"thread_id": thread_id, "thread_ts": before.isoformat()}}
+        if before
+        else None
+    )
+    if summary:
+        return [
+            {
+                "thread_ts": s.thread_ts.isoformat(),
+                "parent_ts": s.parent_ts.isoformat() if s.parent_ts else None,
+                "message_count": s.message_count,
+                "size": s.size,
+                "metadata": s.metadata,
+            }
+            for s in await CHECKPOINTER.alist_summaries(
+                config, before=before_config, limit=limit
+            )
+        ]
     return [
         {
             "values": c.values,
@@ -149,13 +658,7 @@ async def get_thread_history(*, user_id: str, thread_id: str, assistant: Assista
             "parent": c.parent_config,
         }
         async for c in agent.aget_state_history(
-            {
-                "configurable": {
-                    **assistant["config"]["configurable"],
-                    "thread_id": thread_id,
-                    "assistant_id": assistant["assistant_id"],
-                }
-            }
+            config, before=before_config, limit=limit
         )
     ]
 
@@ -163,32 +666,18 @@ async def get_thread_history(*, user_id: str, thread_id: str, assistant: Assista
 async def put_thread(
     user_id: str, thread_id: str, *, assistant_id: str, name: str
 ) -> Thread:
-    """Modify a thread."""
+    """Modify a thread.
+
+    The thread metadata records the type of its assistant, if the user can
+    read the assistant.
+    """
     updated_at = datetime.now(timezone.utc)
-    assistant = await get_assistant(user_id, assistant_id)
-    metadata = (
-        {"assistant_type": assistant["config"]["configurable"]["type"]}
-        if assistant
-        else None
-    )
     async with get_pg_pool().acquire() as conn:
-        await conn.execute(
-            (
-                "INSERT INTO thread (thread_id, user_id, assistant_id, name, updated_at, metadata) VALUES ($1, $2, $3, $4, $5, $6) "
-                "ON CONFLICT (thread_id) DO UPDATE SET "
-                "user_id = EXCLUDED.user_id,"
-                "assistant_id = EXCLUDED.assistant_id, "
-                "name = EXCLUDED.name, "
-                "updated_at = EXCLUDED.updated_at, "
-                "metadata = EXCLUDED.metadata;"
-            ),
-            thread_id,
-            user_id,
-            assistant_id,
-            name,
-            updated_at,
-            metadata,
+        metadata = await conn.fetchval(
+            _PUT_THREAD_SQL, thread_id, user_id, assistant_id, name, updated_at
         )
+        _threads.invalidate(thread_id)
+        mark_written(user_id)
         return {
             "thread_id": thread_id,
             "user_id": user_id,
@@ -199,6 +688,46 @@ async def put_thread(
         }
 
 
+async def fork_thread(
+    user_id: str,
+    thread_id: str,
+    *,
+    thread_ts: Optional[datetime] = None,
+    name: Optional[str] = None,
+) -> Optional[Thread]:
+    """Create a new thread that starts from a checkpoint of another thread.
+
+    The checkpoint is not copied, the new thread refers to it until its state
+    changes.
+
+    Args:
+        user_id: The user ID.
+        thread_id: The thread to fork.
+        thread_ts: The checkpoint to fork from, the latest one if not set.
+        name: The name of the new thread, defaults to the name of the source.
+
+    Returns:
+        The new thread, or None if the source thread does not exist.
+
+    Raises:
+        ValueError: If the source thread has no such checkpoint.
+    """
+    source = await get_thread(user_id, thread_id)
+    if source is None:
+        return None
+    fork_id = str(uuid4())
+    configurable = {"thread_id": thread_id}
+    if thread_ts is not None:
+        configurable["thread_ts"] = thread_ts.isoformat()
+    await CHECKPOINTER.afork({"configurable": configurable}, fork_id)
+    return await put_thread(
+        user_id,
+        fork_id,
+        assistant_id=source["assistant_id"],
+        name=name or source["name"],
+    )
+
+
 async def delete_thread(user_id: str, thread_id: str):
     """Delete a thread by ID."""
     async with get_pg_pool().acquire() as conn:
@@ -207,23 +736,42 @@ async def delete_thread(user_id: str, thread_id: str):
             thread_id,
             user_id,
         )
+    _threads.invalidate(thread_id)
+    mark_written(user_id)
 
 
 async def get_or_create_user(sub: str) -> tuple[User, bool]:
     """Returns a tuple of the user and a boolean indicating whether the user was created."""
+    if (user := _users.rows.get(sub)) is not None:
+        return user, False
+    version = _users.version
     async with get_pg_pool().acquire() as conn:
-        if user := await conn.fetchrow('SELECT * FROM "user" WHERE sub = $1', sub):
-            return user, False
-        user = await conn.fetchrow(
-            'INSERT INTO "user" (sub) VALUES ($1) RETURNING *', sub
-        )
-        return user, True
+        row = await conn.fetchrow(_GET_OR_CREATE_USER_SQL, sub)
+        if row is None:
+            # Created concurrently, the next statement sees it.
+            row = await conn.fetchrow(_GET_OR_CREATE_USER_SQL, sub)
+    user = {k: v for k, v in row.items() if k != "created"}
+    _users.fill(sub, user, version)
+    return user, row["created"]
+
 
 async def delete_user(sub: str, user_id: str):
-    """Delete a user by ID."""
+    """Delete a user by ID, with their threads and assistants.
+
+    What those leave behind is removed in the background, see
+    `app.maintenance.collect_garbage`.
+    """
     async with get_pg_pool().acquire() as conn:
-        await conn.execute(
-            'DELETE FROM "user" WHERE sub = $1 AND user_id = $2',
-            sub,
-            user_id,
-        )
+        async with conn.transaction():
+            if not await conn.fetchval(
+                'SELECT 1 FROM "user" WHERE sub = $1 AND user_id = $2 FOR UPDATE',
+                sub,
+                user_id,
+            ):
+                return
+            await conn.execute("DELETE FROM thread WHERE user_id = $1", user_id)
+            await conn.execute("DELETE FROM assistant WHERE user_id = $1", user_id)
+            await conn.execute('DELETE FROM "user" WHERE user_id = $1', user_id)
+    _users.invalidate(sub)
+    _threads.invalidate()
+    _assistants.invalidate()
@@ -1,22 +1,49 @@
+import asyncio
 import functools
-from typing import Any, AsyncIterator, Dict, Optional, Sequence, Union
+import itertools
+import operator
+import os
+from collections import deque
+from typing import Any, AsyncIterator, Dict, NamedTuple, Optional, Sequence, Union
 
 import orjson
 import structlog
-from langchain_core.messages import AnyMessage, BaseMessage, message_chunk_to_message
+from langchain_core.messages import (
+    AnyMessage,
+    BaseMessage,
+    BaseMessageChunk,
+    message_chunk_to_message,
+)
 from langchain_core.runnables import Runnable, RunnableConfig
 
 logger = structlog.get_logger(__name__)
 
-MessagesStream = AsyncIterator[Union[list[AnyMessage], str]]
+MessagesStream = AsyncIterator[Union[list[AnyMessage], BaseMessageChunk, str]]
+
+# Tokens of a message streamed within this many seconds, or until they add up
+# to this many bytes, are sent as one event. 0 seconds sends every token.
+STREAM_COALESCE_SECONDS = float(os.environ.get("STREAM_COALESCE_SECONDS", 0.03))
+STREAM_COALESCE_MAX_BYTES = int(os.environ.get("STREAM_COALESCE_MAX_BYTES", 1024))
+# Events kept per run for clients that reconnect, and seconds to keep them for
+# once the run ended.
+STREAM_RESUME_MAX_EVENTS = int(os.environ.get("STREAM_RESUME_MAX_EVENTS", 1000))
+STREAM_RESUME_SECONDS = float(os.environ.get("STREAM_RESUME_SECONDS", 60))
 
 
 async def astream_state(
     app: Runnable,
     input: Union[Sequence[AnyMessage], Dict[str, Any]],
     config: RunnableConfig,
+    *,
+    deltas: bool = False,
 ) -> MessagesStream:
-    """Stream messages from the runnable."""
+    """Stream messages from the runnable.
+
+    Yields the run ID, then lists of new or changed messages. While a chat
+    model streams a message, each token yields the message so far, or only
+    the new chunk if `deltas` is set; the complete message follows either way
+    once it is added to the state.
+    """
     root_run_id: Optional[str] = None
     messages: dict[str, BaseMessage] = {}
 
@@ -45,6 +72,8 @@ async def astream_state(
                     new_messages.append(msg)
             if new_messages:
                 yield new_messages
+        elif event["event"] == "on_chat_model_stream" and deltas:
+            yield event["data"]["chunk"]
         elif event["event"] == "on_chat_model_stream":
             message: BaseMessage = event["data"]["chunk"]
             if message.id not in messages:
@@ -54,6 +83,134 @@ async def astream_state(
             yield [messages[message.id]]
 
 
+def _streamed_message(item: Any) -> Optional[BaseMessageChunk]:
+    """The message being streamed that `item` is a token of, if it is one."""
+    if isinstance(item, BaseMessageChunk):
+        return item
+    if (
+        isinstance(item, list)
+        and len(item) == 1
+        and isinstance(item[0], BaseMessageChunk)
+    ):
+        return item[0]
+    return None
+
+
+def _content_size(message: BaseMessageChunk) -> int:
+    content = message.content
+    size = len(content) if isinstance(content, str) else len(dumps(content))
+    for tool_call_chunk in getattr(message, "tool_call_chunks", None) or []:
+        size += len(tool_call_chunk.get("args") or "")
+    return size
+
+
+def _merge(items: list) -> Any:
+    """Merge consecutive tokens of a message into one."""
+    if len(items) == 1 or not isinstance(items[0], BaseMessageChunk):
+        # Each partial message holds the ones before it.
+        return items[-1]
+    if all(
+        isinstance(chunk.content, str)
+        and not chunk.additional_kwargs
+        and not chunk.response_metadata
+        and not getattr(chunk, "tool_call_chunks", None)
+        for chunk in items
+    ):
+        # Adding up chunks one by one builds a new message for each of them.
+        return items[0].copy(
+            update={"content": "".join(chunk.content for chunk in items)}
+        )
+    return functools.reduce(operator.add, items)
+
+
+class _Failure(NamedTuple):
+    error: BaseException
+
+
+_END = object()
+
+
+async def coalesce(
+    stream: MessagesStream,
+    window_seconds: float = STREAM_COALESCE_SECONDS,
+    max_bytes: int = STREAM_COALESCE_MAX_BYTES,
+) -> MessagesStream:
+    """Merge the tokens of a message that arrive in quick succession.
+
+    Delta chunks of the same message are added up, and of consecutive partial
+    messages only the latest is kept. They are sent `window_seconds` after the
+    first of them arrived, once their content grew by `max_bytes`, or as soon
+    as anything else arrives, which is passed on immediately.
+
+    The stream is consumed by a task of its own, so that the window can end
+    while waiting for the next token.
+    """
+    if window_seconds <= 0:
+        async for item in stream:
+            yield item
+        return
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    tokens: list = []
+    size = 0
+    # Content size of each message as last sent.
+    sent_sizes: dict[str, int] = {}
+    timer: Optional[asyncio.TimerHandle] = None
+
+    def flush() -> None:
+        nonlocal size, timer
+        if timer is not None:
+            timer.cancel()
+            timer = None
+        if tokens:
+            item = _merge(tokens)
+            message = _streamed_message(item)
+            sent_sizes[message.id] = _content_size(message)
+            queue.put_nowait(item)
+            tokens.clear()
+            size = 0
+
+    async def produce() -> None:
+        nonlocal size, timer
+        try:
+            async for item in stream:
+                message = _streamed_message(item)
+                if message is None:
+                    flush()
+                    queue.put_nowait(item)
+                    continue
+                if tokens and _streamed_message(tokens[0]).id != message.id:
+                    flush()
+                if not tokens:
+                    timer = loop.call_later(window_seconds, flush)
+                tokens.append(item)
+                if isinstance(item, BaseMessageChunk):
+                    size += _content_size(message)
+                else:
+                    # Partial messages repeat what was sent before.
+                    size = _content_size(message) - sent_sizes.get(message.id, 0)
+                if size >= max_bytes:
+                    flush()
+            flush()
+        except Exception as e:
+            flush()
+            queue.put_nowait(_Failure(e))
+        finally:
+            queue.put_nowait(_END)
+
+    producer = asyncio.ensure_future(produce())
+    try:
+        while (item := await queue.get()) is not _END:
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        if timer is not None:
+            timer.cancel()
+        producer.cancel()
+        await asyncio.gather(producer, return_exceptions=True)
+
+
 def _default(obj) -> Any:
     if hasattr(obj, "dict") and callable(obj.dict):
         return obj.dict()
@@ -63,6 +220,20 @@ def _default(obj) -> Any:
 dumps = functools.partial(orjson.dumps, default=_default)
 
 
+def _delta(chunk: BaseMessageChunk) -> dict[str, Any]:
+    """The new part of a streamed message, to be appended to its previous parts.
+
+    Content strings are concatenated, and so are the `args` of tool call chunks
+    with the same index.
+    """
+    delta = {"id": chunk.id, "type": chunk.type, "content": chunk.content}
+    if tool_call_chunks := getattr(chunk, "tool_call_chunks", None):
+        delta["tool_call_chunks"] = tool_call_chunks
+    if chunk.additional_kwargs:
+        delta["additional_kwargs"] = chunk.additional_kwargs
+    return delta
+
+
 async def to_sse(messages_stream: MessagesStream) -> AsyncIterator[dict]:
     """Consume the stream into an EventSourceResponse"""
     try:
@@ -75,6 +246,8 @@ async def to_sse(messages_stream: MessagesStream) -> AsyncIterator[dict]:
                     "event": "metadata",
                     "data": orjson.dumps({"run_id": chunk}).decode(),
                 }
+            elif isinstance(chunk, BaseMessageChunk):
+                yield {"event": "delta", "data": dumps(_delta(chunk)).decode()}
             else:
                 yield {
                     "event": "data",
@@ -96,3 +269,83 @@ async def to_sse(messages_stream: MessagesStream) -> AsyncIterator[dict]:
 
     # Send an end event to signal the end of the stream
     yield {"event": "end"}
+
+
+class RunStream:
+    """The server-sent events of a run, numbered so that clients can resume.
+
+    The events are consumed by a task of its own, so the run goes on when a
+    client disconnects. The last `max_events` of them are kept, and the stream
+    is found by `get_run_stream` until `STREAM_RESUME_SECONDS` after the run
+    ended. Streams live in the worker that started the run.
+    """
+
+    def __init__(
+        self,
+        run_id: str,
+        user_id: str,
+        events: AsyncIterator[dict],
+        max_events: int = STREAM_RESUME_MAX_EVENTS,
+    ) -> None:
+        self.run_id = run_id
+        self.user_id = user_id
+        self.done = False
+        self._events: deque[dict] = deque(maxlen=max_events)
+        self._last_id = 0
+        # Set and replaced on every new event.
+        self._changed = asyncio.Event()
+        _run_streams[run_id] = self
+        self._task = asyncio.ensure_future(self._consume(events))
+
+    async def _consume(self, events: AsyncIterator[dict]) -> None:
+        try:
+            async for event in events:
+                self._last_id += 1
+                self._events.append({**event, "id": str(self._last_id)})
+                self._changed.set()
+                self._changed = asyncio.Event()
+        finally:
+            self.done = True
+            self._changed.set()
+            asyncio.get_running_loop().call_later(
+                STREAM_RESUME_SECONDS, _run_streams.pop, self.run_id, None
+            )
+
+    async def subscribe(self, last_event_id: int = 0) -> AsyncIterator[dict]:
+        """The events after `last_event_id`, then new events as they come.
+
+        If some of the events after `last_event_id` were dropped already, an
+        error event ends the stream instead.
+        """
+        # Ids that were never sent mean the client missed nothing, and negative
+        # ones that it saw nothing.
+        last_event_id = min(max(last_event_id, 0), self._last_id)
+        while True:
+            changed = self._changed
+            first_id = self._last_id - len(self._events) + 1
+            if last_event_id + 1 < first_id:
+                yield {
+                    "event": "error",
+                    "data": orjson.dumps(
+                        {"status_code": 410, "message": "Missed events expired"}
+                    ).decode(),
+                }
+                yield {"event": "end"}
+                return
+            # Copied, as the events may change while the client reads them.
+            for event in list(
+                itertools.islice(self._events, last_event_id + 1 - first_id, None)
+            ):
+                yield event
+                last_event_id = int(event["id"])
+            if self.done and last_event_id >= self._last_id:
+                return
+            await changed.wait()
+
+
+_run_streams: dict[str, RunStream] = {}
+
+
+def get_run_stream(run_id: str) -> Optional[RunStream]:
+    """The stream of a run started by this worker, if it is still kept."""
+    return _run_streams.get(run_id)
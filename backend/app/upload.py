@@ -27,6 +27,7 @@ from langchain_text_splitters import RecursiveCharacterTextSplitter, TextSplitte
 
 from app.ingest import ingest_blob
 from app.parsing import MIMETYPE_BASED_PARSER
+from app.lifespan import VECTORSTORE_POOL_SIZE
 from app.load_docs import get_md_files_sections
 
 def _guess_mimetype(file_name: str, file_bytes: bytes) -> str:
@@ -88,6 +89,7 @@ def _determine_azure_or_openai_embeddings() -> PGVector:
             connection_string=PG_CONNECTION_STRING,
             embedding_function=OpenAIEmbeddings(),
             use_jsonb=True,
+            engine_args=_ENGINE_ARGS,
         )
     if os.environ.get("AZURE_OPENAI_API_KEY"):
         return PGVector(
@@ -100,6 +102,7 @@ def _determine_azure_or_openai_embeddings() -> PGVector:
                 openai_api_version=os.environ.get("AZURE_OPENAI_API_VERSION"),
             ),
             use_jsonb=True,
+            engine_args=_ENGINE_ARGS,
         )
     raise ValueError(
         "Either OPENAI_API_KEY or AZURE_OPENAI_API_KEY needs to be set for embeddings to work."
@@ -171,6 +174,7 @@ class IngestRunnable(RunnableSerializable[BinaryIO, List[str]]):
             ids.extend(self.vectorstore.add_documents(docs_to_index))
         return ids
 
+_ENGINE_ARGS = {"pool_size": VECTORSTORE_POOL_SIZE, "max_overflow": 0}
 PG_CONNECTION_STRING = PGVector.connection_string_from_db_params(
     driver="psycopg2",
     host=os.environ["POSTGRES_HOST"],
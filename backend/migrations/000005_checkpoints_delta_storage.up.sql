@@ -0,0 +1,2 @@
+ALTER TABLE checkpoints
+    ADD COLUMN IF NOT EXISTS is_snapshot BOOLEAN NOT NULL DEFAULT true;
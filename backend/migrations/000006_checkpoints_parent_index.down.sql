@@ -0,0 +1 @@
+DROP INDEX IF EXISTS checkpoints_thread_id_parent_ts_idx;
@@ -0,0 +1,11 @@
+-- Rows written before parent_ts was recorded form a linear history per thread.
+UPDATE checkpoints c
+    SET parent_ts = (
+        SELECT max(p.thread_ts)
+        FROM checkpoints p
+        WHERE p.thread_id = c.thread_id AND p.thread_ts < c.thread_ts
+    )
+WHERE c.parent_ts IS NULL;
+
+CREATE INDEX IF NOT EXISTS checkpoints_thread_id_parent_ts_idx
+    ON checkpoints (thread_id, parent_ts);
@@ -0,0 +1,2 @@
+ALTER TABLE checkpoints
+    DROP COLUMN IF EXISTS message_count;
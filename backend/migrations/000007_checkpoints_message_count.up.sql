@@ -0,0 +1,2 @@
+ALTER TABLE checkpoints
+    ADD COLUMN IF NOT EXISTS message_count INTEGER;
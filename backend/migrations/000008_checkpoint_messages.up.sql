@@ -0,0 +1,6 @@
+CREATE TABLE IF NOT EXISTS checkpoint_messages (
+    thread_id TEXT NOT NULL,
+    message_hash BYTEA NOT NULL,
+    message BYTEA NOT NULL,
+    PRIMARY KEY (thread_id, message_hash)
+);
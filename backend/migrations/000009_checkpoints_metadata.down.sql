@@ -0,0 +1,4 @@
+DROP INDEX IF EXISTS checkpoints_run_id_idx;
+DROP INDEX IF EXISTS checkpoints_metadata_idx;
+ALTER TABLE checkpoints
+    DROP COLUMN IF EXISTS metadata;
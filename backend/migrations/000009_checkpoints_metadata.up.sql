@@ -0,0 +1,11 @@
+ALTER TABLE checkpoints
+    ADD COLUMN IF NOT EXISTS metadata JSONB;
+
+-- Containment filters, e.g. metadata @> '{"source": "loop"}'.
+CREATE INDEX IF NOT EXISTS checkpoints_metadata_idx
+    ON checkpoints USING gin (metadata jsonb_path_ops);
+
+-- All the checkpoints of a run.
+CREATE INDEX IF NOT EXISTS checkpoints_run_id_idx
+    ON checkpoints ((metadata->>'run_id'))
+    WHERE metadata ? 'run_id';
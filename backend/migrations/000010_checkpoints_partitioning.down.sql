@@ -0,0 +1,32 @@
+ALTER TABLE checkpoints RENAME TO checkpoints_partitioned;
+DROP INDEX IF EXISTS checkpoints_thread_id_parent_ts_idx;
+DROP INDEX IF EXISTS checkpoints_metadata_idx;
+DROP INDEX IF EXISTS checkpoints_run_id_idx;
+ALTER TABLE checkpoints_partitioned
+    RENAME CONSTRAINT checkpoints_pkey TO checkpoints_partitioned_pkey;
+
+CREATE TABLE checkpoints (
+    thread_id TEXT NOT NULL,
+    checkpoint BYTEA NOT NULL,
+    thread_ts TIMESTAMPTZ NOT NULL,
+    parent_ts TIMESTAMPTZ,
+    is_snapshot BOOLEAN NOT NULL DEFAULT true,
+    message_count INTEGER,
+    metadata JSONB,
+    PRIMARY KEY (thread_id, thread_ts)
+);
+
+INSERT INTO checkpoints
+    (thread_id, checkpoint, thread_ts, parent_ts, is_snapshot, message_count, metadata)
+SELECT thread_id, checkpoint, thread_ts, parent_ts, is_snapshot, message_count, metadata
+FROM checkpoints_partitioned;
+
+DROP TABLE checkpoints_partitioned;
+
+CREATE INDEX checkpoints_thread_id_parent_ts_idx
+    ON checkpoints (thread_id, parent_ts);
+CREATE INDEX checkpoints_metadata_idx
+    ON checkpoints USING gin (metadata jsonb_path_ops);
+CREATE INDEX checkpoints_run_id_idx
+    ON checkpoints ((metadata->>'run_id'))
+    WHERE metadata ? 'run_id';
@@ -0,0 +1,59 @@
+-- Partition checkpoints by hash of thread_id, so that vacuum and index
+-- maintenance work on 16 small tables instead of one large one. Every query
+-- on checkpoints filters on thread_id, which prunes to a single partition.
+--
+-- Each hash partition is itself partitioned by range of thread_ts. Until
+-- monthly partitions are created (see CHECKPOINT_PARTITIONS_MONTHLY in
+-- app/maintenance.py) every row goes to its default partition.
+--
+-- This copies the whole table; on large deployments, run it in a
+-- maintenance window.
+ALTER TABLE checkpoints RENAME TO checkpoints_unpartitioned;
+ALTER TABLE checkpoints_unpartitioned
+    RENAME CONSTRAINT checkpoints_pkey TO checkpoints_unpartitioned_pkey;
+DROP INDEX IF EXISTS checkpoints_thread_id_parent_ts_idx;
+DROP INDEX IF EXISTS checkpoints_metadata_idx;
+DROP INDEX IF EXISTS checkpoints_run_id_idx;
+
+CREATE TABLE checkpoints (
+    thread_id TEXT NOT NULL,
+    checkpoint BYTEA NOT NULL,
+    thread_ts TIMESTAMPTZ NOT NULL,
+    parent_ts TIMESTAMPTZ,
+    is_snapshot BOOLEAN NOT NULL DEFAULT true,
+    message_count INTEGER,
+    metadata JSONB,
+    PRIMARY KEY (thread_id, thread_ts)
+) PARTITION BY HASH (thread_id);
+
+DO $$
+BEGIN
+    FOR i IN 0..15 LOOP
+        EXECUTE format(
+            'CREATE TABLE checkpoints_p%s PARTITION OF checkpoints '
+            'FOR VALUES WITH (MODULUS 16, REMAINDER %s) '
+            'PARTITION BY RANGE (thread_ts)',
+            i, i
+        );
+        EXECUTE format(
+            'CREATE TABLE checkpoints_p%s_default PARTITION OF checkpoints_p%s DEFAULT',
+            i, i
+        );
+    END LOOP;
+END
+$$;
+
+INSERT INTO checkpoints
+    (thread_id, checkpoint, thread_ts, parent_ts, is_snapshot, message_count, metadata)
+SELECT thread_id, checkpoint, thread_ts, parent_ts, is_snapshot, message_count, metadata
+FROM checkpoints_unpartitioned;
+
+DROP TABLE checkpoints_unpartitioned;
+
+CREATE INDEX checkpoints_thread_id_parent_ts_idx
+    ON checkpoints (thread_id, parent_ts);
+CREATE INDEX checkpoints_metadata_idx
+    ON checkpoints USING gin (metadata jsonb_path_ops);
+CREATE INDEX checkpoints_run_id_idx
+    ON checkpoints ((metadata->>'run_id'))
+    WHERE metadata ? 'run_id';
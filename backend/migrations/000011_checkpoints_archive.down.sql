@@ -0,0 +1,3 @@
+-- Archived history can only be decoded by the application; restore it by
+-- listing the history of each archived thread before migrating down.
+DROP TABLE IF EXISTS checkpoints_archive;
@@ -0,0 +1,8 @@
+-- The history of idle threads, all but their latest checkpoint, compressed
+-- into one row per thread. See PostgresCheckpoint.aarchive_thread.
+CREATE TABLE IF NOT EXISTS checkpoints_archive (
+    thread_id TEXT PRIMARY KEY,
+    data BYTEA NOT NULL,
+    row_count INTEGER NOT NULL,
+    archived_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
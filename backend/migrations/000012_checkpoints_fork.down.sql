@@ -0,0 +1,8 @@
+-- Forked threads lose the checkpoint they were forked from.
+DROP INDEX IF EXISTS checkpoints_source_idx;
+
+DELETE FROM checkpoints WHERE source_thread_id IS NOT NULL;
+
+ALTER TABLE checkpoints
+    DROP COLUMN IF EXISTS source_thread_id,
+    DROP COLUMN IF EXISTS source_ts;
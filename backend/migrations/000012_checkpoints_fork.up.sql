@@ -0,0 +1,9 @@
+-- A forked thread starts with a row that refers to the checkpoint it was
+-- forked from instead of a copy of it. See PostgresCheckpoint.afork.
+ALTER TABLE checkpoints
+    ADD COLUMN IF NOT EXISTS source_thread_id TEXT,
+    ADD COLUMN IF NOT EXISTS source_ts TIMESTAMPTZ;
+
+CREATE INDEX IF NOT EXISTS checkpoints_source_idx
+    ON checkpoints (source_thread_id, source_ts)
+    WHERE source_thread_id IS NOT NULL;
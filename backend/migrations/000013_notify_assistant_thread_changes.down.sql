@@ -0,0 +1,5 @@
+DROP TRIGGER IF EXISTS thread_truncated ON thread;
+DROP TRIGGER IF EXISTS thread_changed ON thread;
+DROP TRIGGER IF EXISTS assistant_truncated ON assistant;
+DROP TRIGGER IF EXISTS assistant_changed ON assistant;
+DROP FUNCTION IF EXISTS notify_row_change();
@@ -0,0 +1,29 @@
+-- Tell every API worker when an assistant or thread row changes, so it can
+-- drop the row from its cache. The payload is the id of the row, or empty
+-- when the whole table was truncated.
+CREATE OR REPLACE FUNCTION notify_row_change() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        PERFORM pg_notify(TG_ARGV[0], '');
+    ELSE
+        PERFORM pg_notify(TG_ARGV[0], to_jsonb(OLD) ->> TG_ARGV[1]);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER assistant_changed
+    AFTER UPDATE OR DELETE ON assistant
+    FOR EACH ROW EXECUTE FUNCTION notify_row_change('assistant_changed', 'assistant_id');
+
+CREATE TRIGGER assistant_truncated
+    AFTER TRUNCATE ON assistant
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_row_change('assistant_changed');
+
+CREATE TRIGGER thread_changed
+    AFTER UPDATE OR DELETE ON thread
+    FOR EACH ROW EXECUTE FUNCTION notify_row_change('thread_changed', 'thread_id');
+
+CREATE TRIGGER thread_truncated
+    AFTER TRUNCATE ON thread
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_row_change('thread_changed');
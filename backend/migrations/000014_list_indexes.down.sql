@@ -0,0 +1,6 @@
+DROP INDEX IF EXISTS assistant_public_updated_at_idx;
+DROP INDEX IF EXISTS assistant_user_id_updated_at_idx;
+DROP INDEX IF EXISTS thread_user_id_updated_at_idx;
+
+ALTER TABLE assistant ALTER COLUMN updated_at DROP NOT NULL;
+ALTER TABLE thread ALTER COLUMN updated_at DROP NOT NULL;
@@ -0,0 +1,17 @@
+-- Lists are ordered by (updated_at, id), newest first, and paged by keyset on
+-- that pair, so it has to be set on every row.
+UPDATE thread SET updated_at = now() WHERE updated_at IS NULL;
+ALTER TABLE thread ALTER COLUMN updated_at SET NOT NULL;
+
+UPDATE assistant SET updated_at = now() WHERE updated_at IS NULL;
+ALTER TABLE assistant ALTER COLUMN updated_at SET NOT NULL;
+
+CREATE INDEX IF NOT EXISTS thread_user_id_updated_at_idx
+    ON thread (user_id, updated_at DESC, thread_id DESC);
+
+CREATE INDEX IF NOT EXISTS assistant_user_id_updated_at_idx
+    ON assistant (user_id, updated_at DESC, assistant_id DESC);
+
+CREATE INDEX IF NOT EXISTS assistant_public_updated_at_idx
+    ON assistant (updated_at DESC, assistant_id DESC)
+    WHERE public;
@@ -0,0 +1,16 @@
+-- Store the full config of assistants based on a template. Overrides are
+-- merged into the top level of the template and into its configurable object;
+-- objects nested deeper than that are replaced, not merged.
+UPDATE assistant a
+    SET config = t.config || a.config || jsonb_build_object(
+        'configurable',
+        coalesce(t.config->'configurable', '{}') || coalesce(a.config->'configurable', '{}')
+    )
+FROM assistant_template t
+WHERE t.template_id = a.template_id;
+
+ALTER TABLE assistant DROP COLUMN IF EXISTS template_id;
+
+DROP TABLE IF EXISTS assistant_template;
+
+ALTER TABLE assistant ALTER COLUMN config TYPE JSON USING config::json;
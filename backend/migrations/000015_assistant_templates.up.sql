@@ -0,0 +1,14 @@
+ALTER TABLE assistant ALTER COLUMN config TYPE JSONB USING config::jsonb;
+
+-- Configs shared by many assistants, addressed by the hash of their content.
+-- An assistant based on a template only stores its differences from it in
+-- config. See storage.put_assistant.
+CREATE TABLE IF NOT EXISTS assistant_template (
+    template_id TEXT PRIMARY KEY,
+    config JSONB NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+ALTER TABLE assistant
+    ADD COLUMN IF NOT EXISTS template_id TEXT
+        REFERENCES assistant_template(template_id);
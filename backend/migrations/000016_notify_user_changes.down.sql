@@ -0,0 +1,2 @@
+DROP TRIGGER IF EXISTS user_truncated ON "user";
+DROP TRIGGER IF EXISTS user_changed ON "user";
@@ -0,0 +1,8 @@
+-- Authenticated users are cached by sub, see notify_row_change.
+CREATE TRIGGER user_changed
+    AFTER UPDATE OR DELETE ON "user"
+    FOR EACH ROW EXECUTE FUNCTION notify_row_change('user_changed', 'sub');
+
+CREATE TRIGGER user_truncated
+    AFTER TRUNCATE ON "user"
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_row_change('user_changed');
@@ -0,0 +1,4 @@
+DROP TRIGGER IF EXISTS assistant_gc ON assistant;
+DROP TRIGGER IF EXISTS thread_gc ON thread;
+DROP FUNCTION IF EXISTS enqueue_gc();
+DROP TABLE IF EXISTS gc_queue;
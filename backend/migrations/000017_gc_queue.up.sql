@@ -0,0 +1,28 @@
+-- Data left behind by deleted threads and assistants, removed in the
+-- background by maintenance.collect_garbage.
+--   thread:    checkpoints, stored messages, archive and uploaded documents
+--              of a thread.
+--   namespace: uploaded documents of an assistant or thread.
+CREATE TABLE IF NOT EXISTS gc_queue (
+    kind TEXT NOT NULL,
+    id TEXT NOT NULL,
+    enqueued_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (kind, id)
+);
+
+CREATE OR REPLACE FUNCTION enqueue_gc() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO gc_queue (kind, id)
+    VALUES (TG_ARGV[0], to_jsonb(OLD) ->> TG_ARGV[1])
+    ON CONFLICT DO NOTHING;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER thread_gc
+    AFTER DELETE ON thread
+    FOR EACH ROW EXECUTE FUNCTION enqueue_gc('thread', 'thread_id');
+
+CREATE TRIGGER assistant_gc
+    AFTER DELETE ON assistant
+    FOR EACH ROW EXECUTE FUNCTION enqueue_gc('namespace', 'assistant_id');
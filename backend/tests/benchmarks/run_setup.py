@@ -0,0 +1,99 @@
+"""Benchmark looking up the thread and assistant of a run.
+
+Compares the two sequential queries runs used to make with the single JOIN of
+`storage.get_thread_and_assistant`, with and without the lookup cache.
+
+Run against a migrated database, configured with the usual POSTGRES_*
+environment variables:
+
+    poetry run python -m tests.benchmarks.run_setup [iterations]
+"""
+
+import asyncio
+import statistics
+import sys
+import time
+from typing import Awaitable, Callable
+from uuid import uuid4
+
+import app.storage as storage
+from app.lifespan import get_pg_pool, lifespan
+from app.server import app
+
+
+async def _two_queries(user_id: str, thread_id: str) -> None:
+    async with get_pg_pool().acquire() as conn:
+        thread = await conn.fetchrow(
+            "SELECT * FROM thread WHERE thread_id = $1 AND user_id = $2",
+            thread_id,
+            user_id,
+        )
+    async with get_pg_pool().acquire() as conn:
+        await conn.fetchrow(
+            "SELECT * FROM assistant WHERE assistant_id = $1 "
+            "AND (user_id = $2 OR public IS true)",
+            thread["assistant_id"],
+            user_id,
+        )
+
+
+async def _join(user_id: str, thread_id: str) -> None:
+    storage.clear_caches()
+    await storage.get_thread_and_assistant(user_id, thread_id)
+
+
+async def _cached(user_id: str, thread_id: str) -> None:
+    await storage.get_thread_and_assistant(user_id, thread_id)
+
+
+async def _measure(
+    fn: Callable[[str, str], Awaitable[None]],
+    user_id: str,
+    thread_id: str,
+    iterations: int,
+) -> list[float]:
+    for _ in range(10):
+        await fn(user_id, thread_id)
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        await fn(user_id, thread_id)
+        timings.append((time.perf_counter() - start) * 1e6)
+    return timings
+
+
+async def main(iterations: int) -> None:
+    async with lifespan(app):
+        user, _ = await storage.get_or_create_user(f"benchmark-{uuid4()}")
+        user_id = user["user_id"]
+        assistant = await storage.put_assistant(
+            user_id,
+            str(uuid4()),
+            name="benchmark",
+            config={"configurable": {"type": "chatbot"}},
+        )
+        thread = await storage.put_thread(
+            user_id,
+            str(uuid4()),
+            assistant_id=assistant["assistant_id"],
+            name="benchmark",
+        )
+        try:
+            for name, fn in [
+                ("two queries", _two_queries),
+                ("join", _join),
+                ("join, cached", _cached),
+            ]:
+                timings = await _measure(fn, user_id, thread["thread_id"], iterations)
+                print(
+                    f"{name:>14}: median {statistics.median(timings):8.1f} us, "
+                    f"p95 {statistics.quantiles(timings, n=20)[-1]:8.1f} us"
+                )
+        finally:
+            await storage.delete_thread(user_id, thread["thread_id"])
+            await storage.delete_assistant(user_id, assistant["assistant_id"])
+            await storage.delete_user(user["sub"], user_id)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000))
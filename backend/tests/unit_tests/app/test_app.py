@@ -1,10 +1,21 @@
 """Test the server and client together."""
 
+import asyncio
+import os
+from datetime import datetime, timezone
 from typing import Optional, Sequence
 from uuid import uuid4
 
 import asyncpg
+import pytest
+from langchain_core.messages import HumanMessage
+from langgraph.checkpoint.base import copy_checkpoint, empty_checkpoint
 
+import app.lifespan as lifespan
+import app.storage as storage
+from app.agent import CHECKPOINTER
+from app.checkpoint import PostgresCheckpoint, VersionedCheckpointSerializer
+from app.pool import create_pool
 from tests.unit_tests.app.helpers import get_client
 
 
@@ -126,3 +137,394 @@ async def test_threads() -> None:
             headers={"Cookie": "opengpts_user_id=2"},
         )
         assert response.status_code == 422
+
+
+async def test_thread_cache_invalidated_by_other_writers(
+    pool: asyncpg.pool.Pool,
+) -> None:
+    """A thread changed outside this worker is dropped from its cache."""
+    headers = {"Cookie": "opengpts_user_id=1"}
+    aid = str(uuid4())
+    tid = str(uuid4())
+
+    async with get_client() as client:
+        await client.put(
+            f"/assistants/{aid}",
+            json={
+                "name": "assistant",
+                "config": {"configurable": {"type": "chatbot"}},
+                "public": False,
+            },
+            headers=headers,
+        )
+        await client.put(
+            f"/threads/{tid}",
+            json={"name": "bobby", "assistant_id": aid},
+            headers=headers,
+        )
+        response = await client.get(f"/threads/{tid}", headers=headers)
+        assert response.json()["name"] == "bobby"
+
+        async with pool.acquire() as conn:
+            await conn.execute(
+                "UPDATE thread SET name = 'alice' WHERE thread_id = $1", tid
+            )
+        for _ in range(50):
+            response = await client.get(f"/threads/{tid}", headers=headers)
+            if response.json()["name"] == "alice":
+                break
+            await asyncio.sleep(0.1)
+        assert response.json()["name"] == "alice"
+
+
+async def test_get_thread_and_assistant(pool: asyncpg.pool.Pool) -> None:
+    """The assistant of a thread is only returned if the user can read it."""
+    owner, _ = await storage.get_or_create_user("owner")
+    user, _ = await storage.get_or_create_user("user")
+    config = {"configurable": {"type": "chatbot"}}
+    private = await storage.put_assistant(
+        owner["user_id"], str(uuid4()), name="private", config=config
+    )
+    public = await storage.put_assistant(
+        owner["user_id"], str(uuid4()), name="public", config=config, public=True
+    )
+    for assistant, expected in [(private, None), (public, public)]:
+        tid = str(uuid4())
+        await storage.put_thread(
+            user["user_id"], tid, assistant_id=assistant["assistant_id"], name="t"
+        )
+        for _ in range(2):  # From the database, then from the cache.
+            thread, found = await storage.get_thread_and_assistant(user["user_id"], tid)
+            assert thread["thread_id"] == tid
+            assert thread["metadata"] == (expected and {"assistant_type": "chatbot"})
+            assert (found and found["assistant_id"]) == (
+                expected and expected["assistant_id"]
+            )
+        assert await storage.get_thread_and_assistant(owner["user_id"], tid) == (
+            None,
+            None,
+        )
+
+
+async def test_list_pagination(pool: asyncpg.pool.Pool) -> None:
+    """Lists page through items newest first, following X-Next-Cursor."""
+    headers = {"Cookie": "opengpts_user_id=1"}
+    aid = str(uuid4())
+
+    async with get_client() as client:
+        await client.put(
+            f"/assistants/{aid}",
+            json={
+                "name": "assistant",
+                "config": {"configurable": {"type": "chatbot"}},
+                "public": True,
+            },
+            headers=headers,
+        )
+        for i in range(5):
+            await client.put(
+                f"/threads/{uuid4()}",
+                json={"name": f"thread {i}", "assistant_id": aid},
+                headers=headers,
+            )
+
+        names = []
+        params = {"limit": 2}
+        while True:
+            response = await client.get("/threads/", params=params, headers=headers)
+            assert response.status_code == 200
+            names.extend(t["name"] for t in response.json())
+            if "X-Next-Cursor" not in response.headers:
+                break
+            params["cursor"] = response.headers["X-Next-Cursor"]
+        assert names == [f"thread {i}" for i in reversed(range(5))]
+
+        response = await client.get(
+            "/threads/", params={"cursor": "not a cursor"}, headers=headers
+        )
+        assert response.status_code == 400
+
+        for path in ["/assistants/", "/assistants/public/"]:
+            response = await client.get(
+                path, params={"include_config": False}, headers=headers
+            )
+            assert [a["assistant_id"] for a in response.json()] == [aid]
+            assert "config" not in response.json()[0]
+
+
+async def test_default_assistant_is_based_on_template(pool: asyncpg.pool.Pool) -> None:
+    """Default assistants only store how they differ from the shared template."""
+    async with get_client() as client:
+        response = await client.post(
+            "/assistants/getorcreate",
+            json={"user_name": "alice", "gitee_name": "alice"},
+        )
+        assert response.status_code == 200, response.text
+        assistant = response.json()
+        configurable = assistant["config"]["configurable"]
+        assert len(configurable["type==agent/tools"]) == 25
+        assert configurable["type==agent/system_message"].endswith("alice")
+
+        async with pool.acquire() as conn:
+            stored = await conn.fetchval(
+                "SELECT config FROM assistant WHERE assistant_id = $1",
+                assistant["assistant_id"],
+            )
+        assert set(stored["configurable"]) == {
+            "type==agent/system_message",
+            "type==chat_retrieval/system_message",
+        }
+
+        user_id = assistant["user_id"]
+        response = await client.put(
+            f"/assistants/{assistant['assistant_id']}",
+            json={
+                "name": "renamed",
+                "config": {"configurable": {**configurable, "type==agent/tools": []}},
+            },
+            headers={"Cookie": "opengpts_user_id=alice"},
+        )
+        assert response.status_code == 200, response.text
+        fetched = await storage.get_assistant(user_id, assistant["assistant_id"])
+        assert fetched["template_id"] is not None
+        assert fetched["config"]["configurable"]["type==agent/tools"] == []
+        assert fetched["config"]["configurable"]["type"] == "agent"
+
+
+async def test_get_or_create_user(pool: asyncpg.pool.Pool) -> None:
+    """Users are created once, cached, and forgotten when deleted."""
+    results = await asyncio.gather(
+        *(storage.get_or_create_user("concurrent") for _ in range(5))
+    )
+    assert sorted(created for _, created in results) == [False] * 4 + [True]
+    assert len({user["user_id"] for user, _ in results}) == 1
+
+    user, created = await storage.get_or_create_user("concurrent")
+    assert not created
+    await storage.delete_user(user["sub"], user["user_id"])
+    new_user, created = await storage.get_or_create_user("concurrent")
+    assert created
+    assert new_user["user_id"] != user["user_id"]
+
+
+async def test_pool_stats(pool: asyncpg.pool.Pool) -> None:
+    """Pool use is reported with a cumulative acquire latency histogram."""
+    async with pool.acquire() as conn:
+        held = pool.stats()
+        assert await conn.fetchval("SHOW jit") == "off"
+    async with get_client() as client:
+        response = await client.get("/stats/pool")
+    assert response.status_code == 200
+    stats = response.json()
+
+    assert held["in_use"] >= 1
+    assert stats["in_use"] + stats["idle"] == stats["size"]
+    assert stats["waiters"] == 0
+    assert stats["acquires"] > 0
+    assert stats["acquire_seconds"]["+Inf"] == stats["acquires"]
+    counts = list(stats["acquire_seconds"].values())
+    assert counts == sorted(counts)
+
+
+async def test_pool_stats_count_timeouts() -> None:
+    """Connections acquired either way are counted, and so are timeouts."""
+    small = await create_pool(
+        min_size=1,
+        max_size=1,
+        acquire_timeout=0.01,
+        database=os.environ["POSTGRES_DB"],
+        user=os.environ["POSTGRES_USER"],
+        password=os.environ["POSTGRES_PASSWORD"],
+        host=os.environ["POSTGRES_HOST"],
+        port=os.environ["POSTGRES_PORT"],
+    )
+    try:
+        conn = await small.acquire()
+        with pytest.raises(asyncio.TimeoutError):
+            await small.fetchval("SELECT 1")
+        assert small.stats()["in_use"] == 1
+        await small.release(conn)
+        assert await small.fetchval("SELECT 1") == 1
+
+        stats = small.stats()
+        assert stats["acquires"] == 2
+        assert stats["acquire_timeouts"] == 1
+        assert stats["in_use"] == 0
+        assert stats["waiters"] == 0
+    finally:
+        await small.close()
+
+
+async def test_replica_reads(
+    pool: asyncpg.pool.Pool, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Reads go to the replica, except of what was just written."""
+    replica = await create_pool(
+        min_size=1,
+        max_size=2,
+        init=lifespan._init_connection,
+        database=os.environ["POSTGRES_DB"],
+        user=os.environ["POSTGRES_USER"],
+        password=os.environ["POSTGRES_PASSWORD"],
+        host=os.environ["POSTGRES_HOST"],
+        port=os.environ["POSTGRES_PORT"],
+    )
+    monkeypatch.setattr(lifespan, "_pg_replica_pool", replica)
+    checkpointer = PostgresCheckpoint(VersionedCheckpointSerializer("zlib"))
+    try:
+        user, _ = await storage.get_or_create_user("replica")
+        user_id, tid = user["user_id"], str(uuid4())
+        assistant = await storage.put_assistant(
+            user_id, str(uuid4()), name="a", config={"configurable": {"type": "agent"}}
+        )
+        await storage.put_thread(
+            user_id, tid, assistant_id=assistant["assistant_id"], name="t"
+        )
+        config = {"configurable": {"thread_id": tid}}
+        await checkpointer.aput(config, empty_checkpoint())
+
+        await storage.get_thread(user_id, tid)
+        await storage.list_threads(user_id)
+        assert len([c async for c in checkpointer.alist(config)]) == 1
+        assert replica.stats()["acquires"] == 0
+
+        # The replica caught up.
+        lifespan._recent_writes.clear()
+        storage._threads.rows.clear()
+        assert (await storage.get_thread(user_id, tid))["name"] == "t"
+        assert [t["thread_id"] for t in await storage.list_threads(user_id)] == [tid]
+        assert len([c async for c in checkpointer.alist(config)]) == 1
+        assert replica.stats()["acquires"] == 3
+    finally:
+        lifespan._recent_writes.clear()
+        await replica.close()
+
+
+async def test_thread_state_projection_and_etag(pool: asyncpg.pool.Pool) -> None:
+    """Polls of an unchanged state get a 304, and can ask for new messages only."""
+    headers = {"Cookie": "opengpts_user_id=1"}
+    aid, tid = str(uuid4()), str(uuid4())
+    async with get_client() as client:
+        await client.put(
+            f"/assistants/{aid}",
+            json={
+                "name": "assistant",
+                "config": {"configurable": {"type": "chatbot"}},
+                "public": False,
+            },
+            headers=headers,
+        )
+        await client.put(
+            f"/threads/{tid}",
+            json={"name": "bobby", "assistant_id": aid},
+            headers=headers,
+        )
+        response = await client.get(f"/threads/{tid}/state", headers=headers)
+        assert "ETag" not in response.headers
+
+        messages = [
+            {"type": "human", "content": f"m{i}", "id": f"m{i}"} for i in range(4)
+        ]
+        response = await client.post(
+            f"/threads/{tid}/state", json={"values": messages}, headers=headers
+        )
+        assert response.status_code == 200, response.text
+
+        response = await client.get(f"/threads/{tid}/state", headers=headers)
+        etag = response.headers["ETag"]
+        assert [m["id"] for m in response.json()["values"]] == [
+            "m0",
+            "m1",
+            "m2",
+            "m3",
+        ]
+        response = await client.get(
+            f"/threads/{tid}/state", headers={**headers, "If-None-Match": etag}
+        )
+        assert response.status_code == 304
+        assert response.headers["ETag"] == etag
+
+        response = await client.get(
+            f"/threads/{tid}/state", params={"after": "m1"}, headers=headers
+        )
+        assert [m["id"] for m in response.json()["values"]] == ["m2", "m3"]
+        response = await client.get(
+            f"/threads/{tid}/state", params={"limit": 1}, headers=headers
+        )
+        assert [m["id"] for m in response.json()["values"]] == ["m3"]
+        response = await client.get(
+            f"/threads/{tid}/state", params={"after": "gone"}, headers=headers
+        )
+        assert len(response.json()["values"]) == 4
+
+        # Projections of the same state don't share their ETag.
+        response = await client.get(
+            f"/threads/{tid}/state", params={"limit": 1}, headers=headers
+        )
+        limit_etag = response.headers["ETag"]
+        assert limit_etag != etag
+        response = await client.get(
+            f"/threads/{tid}/state",
+            params={"limit": 2},
+            headers={**headers, "If-None-Match": limit_etag},
+        )
+        assert response.status_code == 200
+        assert response.headers["ETag"] != limit_etag
+        assert [m["id"] for m in response.json()["values"]] == ["m2", "m3"]
+        response = await client.get(
+            f"/threads/{tid}/state",
+            params={"limit": 1},
+            headers={**headers, "If-None-Match": limit_etag},
+        )
+        assert response.status_code == 304
+        response = await client.get(
+            f"/threads/{tid}/state",
+            params={"after": "m1"},
+            headers={**headers, "If-None-Match": etag},
+        )
+        assert response.status_code == 200
+
+        # A new message, written by a run.
+        config = {"configurable": {"thread_id": tid}}
+        saved = await CHECKPOINTER.aget_tuple(config)
+        checkpoint = copy_checkpoint(saved.checkpoint)
+        checkpoint["ts"] = datetime.now(timezone.utc).isoformat()
+        checkpoint["channel_values"]["__root__"].append(
+            HumanMessage(content="m4", id="m4")
+        )
+        await CHECKPOINTER.aput(config, checkpoint, saved.metadata)
+        response = await client.get(
+            f"/threads/{tid}/state",
+            params={"after": "m3"},
+            headers={**headers, "If-None-Match": etag},
+        )
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+        assert [m["id"] for m in response.json()["values"]] == ["m4"]
+
+
+async def test_failed_getorcreate_keeps_existing_users(
+    pool: asyncpg.pool.Pool, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """A failure for a user that already existed doesn't delete their data."""
+    async with get_client() as client:
+        response = await client.post(
+            "/assistants/getorcreate",
+            json={"user_name": "bob", "gitee_name": "bob"},
+        )
+        assert response.status_code == 200, response.text
+        assistant_id = response.json()["assistant_id"]
+
+        async def fail(*args, **kwargs):
+            raise ConnectionError
+
+        monkeypatch.setattr(storage, "list_assistants", fail)
+        response = await client.post(
+            "/assistants/getorcreate",
+            json={"user_name": "bob", "gitee_name": "bob"},
+        )
+        assert response.status_code == 400
+
+    user, created = await storage.get_or_create_user("bob")
+    assert not created
+    assert (await storage.get_assistant(user["user_id"], assistant_id)) is not None
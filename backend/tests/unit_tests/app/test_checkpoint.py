@@ -0,0 +1,696 @@
+"""Test checkpoint encoding."""
+
+import asyncio
+import pickle
+from datetime import date, datetime, timedelta, timezone
+from uuid import uuid4
+
+import psycopg
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage
+from langgraph.checkpoint.base import empty_checkpoint
+
+from app.cache import LRUCache
+from app import storage
+from app.maintenance import (
+    _PARTITIONS_SQL,
+    GCSettings,
+    PartitionSettings,
+    _add_months,
+    _month_partition,
+    collect_garbage,
+    manage_partitions,
+    queue_orphans,
+    sweep_messages,
+)
+from app.checkpoint import (
+    CHECKPOINT_MAGIC,
+    CONFIG_KEY_MESSAGE_WINDOW,
+    PickleCheckpointSerializer,
+    PostgresCheckpoint,
+    VersionedCheckpointSerializer,
+    _apply_delta,
+    _diff_checkpoint,
+)
+from app.lifespan import get_pg_pool
+from app.maintenance import RetentionSettings, compact_checkpoints
+from app.message_types import LiberalToolMessage
+
+
+def _checkpoint(messages: list) -> dict:
+    checkpoint = empty_checkpoint()
+    checkpoint["channel_values"] = {"__root__": messages, "agent": "agent"}
+    checkpoint["channel_versions"]["__root__"] = len(messages)
+    return checkpoint
+
+
+def _messages(n: int) -> list:
+    return [
+        HumanMessage(content=f"question {i}", id=f"h{i}")
+        if i % 2 == 0
+        else AIMessage(content="answer " * 200, id=f"a{i}")
+        for i in range(n)
+    ]
+
+
+_OPTIONAL_CODECS = {"zstd": "zstandard", "lz4": "lz4.frame"}
+
+
+@pytest.mark.parametrize("compression", ["none", "zlib", "zstd", "lz4"])
+def test_versioned_serializer_roundtrip(compression: str) -> None:
+    if compression in _OPTIONAL_CODECS:
+        pytest.importorskip(_OPTIONAL_CODECS[compression])
+    serializer = VersionedCheckpointSerializer(compression)
+    checkpoint = _checkpoint(_messages(20))
+
+    data = serializer.dumps(checkpoint)
+
+    assert data.startswith(CHECKPOINT_MAGIC)
+    assert serializer.loads(data) == checkpoint
+    if compression != "none":
+        assert len(data) < len(pickle.dumps(checkpoint)) / 2
+
+
+def test_versioned_serializer_reads_legacy_pickle() -> None:
+    checkpoint = _checkpoint(_messages(3))
+    data = pickle.dumps(checkpoint)
+
+    assert VersionedCheckpointSerializer("zlib").loads(data) == checkpoint
+
+
+def test_delta_roundtrip() -> None:
+    messages = _messages(6)
+    base = _checkpoint(messages[:4])
+    checkpoint = _checkpoint(messages)
+    del checkpoint["channel_values"]["agent"]
+    checkpoint["channel_values"]["action"] = "action"
+
+    delta = _diff_checkpoint(base, checkpoint)
+
+    assert delta["channel_appends"] == {"__root__": messages[4:]}
+    assert delta["channel_values"] == {"action": "action"}
+    assert delta["channel_deletes"] == ["agent"]
+    assert _apply_delta(base, delta) == checkpoint
+
+
+async def test_delta_chain_roundtrip(pool) -> None:
+    checkpointer = PostgresCheckpoint(
+        PickleCheckpointSerializer(), storage_mode="delta", snapshot_interval=3
+    )
+    messages = _messages(7)
+    config = {"configurable": {"thread_id": "delta"}}
+    configs, checkpoints = [], []
+    for i in range(1, len(messages) + 1):
+        checkpoint = _checkpoint(messages[:i])
+        checkpoint["ts"] = datetime(
+            2024, 1, 1, 0, 0, i, tzinfo=timezone.utc
+        ).isoformat()
+        config = await checkpointer.aput(config, checkpoint)
+        configs.append(config)
+        checkpoints.append(checkpoint)
+
+    async with get_pg_pool().acquire() as db:
+        rows = await db.fetch(
+            "SELECT is_snapshot FROM checkpoints WHERE thread_id = $1 "
+            "ORDER BY thread_ts",
+            "delta",
+        )
+    assert [row["is_snapshot"] for row in rows] == [
+        True,
+        False,
+        False,
+        True,
+        False,
+        False,
+        True,
+    ]
+    for config, checkpoint in zip(configs, checkpoints):
+        saved = await checkpointer.aget_tuple(config)
+        assert saved.checkpoint == checkpoint
+        assert saved.config == config
+    latest = await checkpointer.aget_tuple({"configurable": {"thread_id": "delta"}})
+    assert latest.checkpoint == checkpoints[-1]
+    history = [t async for t in checkpointer.alist(config)]
+    assert [t.checkpoint for t in history] == checkpoints[::-1]
+    assert history[0].parent_config == configs[-2]
+
+
+def test_structured_serializer_roundtrip() -> None:
+    serializer = VersionedCheckpointSerializer("zlib", format="structured")
+    messages = _messages(5) + [
+        LiberalToolMessage(content={"docs": [1, 2]}, tool_call_id="call", id="t")
+    ]
+    checkpoint = _checkpoint(messages)
+    checkpoint["channel_values"]["action"] = ("not", "json")
+
+    loaded = serializer.loads(serializer.dumps(checkpoint))
+
+    assert loaded == checkpoint
+    assert type(loaded["channel_values"]["__root__"][-1]) is LiberalToolMessage
+    assert loaded["channel_values"]["action"] == ("not", "json")
+
+
+@pytest.mark.parametrize("format", ["pickle", "structured"])
+def test_serializer_loads_window(format: str) -> None:
+    serializer = VersionedCheckpointSerializer("zlib", format=format)
+    messages = _messages(10)
+    data = serializer.dumps(_checkpoint(messages))
+
+    window = serializer.loads_window(data, 3)
+    assert window["channel_values"]["__root__"] == messages[-3:]
+    assert serializer.loads_window(data, 0)["channel_values"]["__root__"] == []
+    larger = serializer.loads_window(data, 32)
+    assert larger["channel_values"]["__root__"] == messages
+
+
+@pytest.mark.parametrize("message_store", [False, True])
+async def test_message_window_larger_than_thread(message_store: bool) -> None:
+    checkpointer = PostgresCheckpoint(
+        VersionedCheckpointSerializer("zlib", format="structured"),
+        message_store=message_store,
+    )
+    messages = _messages(20)
+    config = {"configurable": {"thread_id": f"window-{message_store}"}}
+    await checkpointer.aput(config, _checkpoint(messages))
+
+    for cached in (True, False):
+        if not cached:
+            checkpointer.cache.clear()
+        for window, expected in ((32, messages), (5, messages[-5:]), (0, [])):
+            windowed = await checkpointer.aget_tuple(
+                {
+                    "configurable": {
+                        **config["configurable"],
+                        CONFIG_KEY_MESSAGE_WINDOW: window,
+                    }
+                }
+            )
+            assert windowed.checkpoint["channel_values"]["__root__"] == expected
+
+
+@pytest.mark.parametrize("message_store", [False, True])
+async def test_compaction_keeps_what_kept_checkpoints_need(
+    message_store: bool,
+) -> None:
+    checkpointer = PostgresCheckpoint(
+        VersionedCheckpointSerializer("zlib"),
+        storage_mode="delta",
+        snapshot_interval=4,
+        message_store=message_store,
+    )
+    messages = _messages(11)
+    config = {"configurable": {"thread_id": "compacted"}}
+    configs = []
+    for i in range(1, len(messages) + 1):
+        checkpoint = _checkpoint(messages[:i])
+        checkpoint["ts"] = datetime(
+            2024, 1, 1, 0, 0, i, tzinfo=timezone.utc
+        ).isoformat()
+        config = await checkpointer.aput(config, checkpoint)
+        configs.append(config)
+    kept = configs[-2:]
+    settings = RetentionSettings(
+        keep_last=2, keep_interrupts=False, min_age_seconds=0, batch_pause_seconds=0
+    )
+    before = [await checkpointer.aget_tuple(c) for c in kept]
+
+    result = await compact_checkpoints(get_pg_pool(), settings)
+
+    assert result.deleted == 8
+    async with get_pg_pool().acquire() as db:
+        rows = await db.fetch(
+            "SELECT is_snapshot FROM checkpoints WHERE thread_id = $1 "
+            "ORDER BY thread_ts",
+            "compacted",
+        )
+    # The snapshot the two kept deltas are rebuilt from is kept too.
+    assert [row["is_snapshot"] for row in rows] == [True, False, False]
+    assert [await checkpointer.aget_tuple(c) for c in kept] == before
+    assert await checkpointer.aget_tuple(configs[0]) is None
+    history = [t async for t in checkpointer.alist(config)]
+    assert [t.config for t in history] == [configs[-1], configs[-2], configs[-3]]
+
+
+async def test_compaction_keeps_interrupts_never_continued() -> None:
+    checkpointer = PostgresCheckpoint(VersionedCheckpointSerializer("zlib"))
+    thread = {"configurable": {"thread_id": "interrupted"}}
+
+    async def put(parent: dict, second: int) -> dict:
+        checkpoint = _checkpoint(_messages(second))
+        checkpoint["ts"] = datetime(
+            2024, 1, 1, 0, 0, second, tzinfo=timezone.utc
+        ).isoformat()
+        return await checkpointer.aput(parent, checkpoint)
+
+    configs = [thread]
+    for i in range(1, 6):
+        configs.append(await put(configs[-1], i))
+    # Branches off the second checkpoint: a run waiting for input, and a
+    # finished one, both abandoned. And an interrupt that was continued.
+    interrupted = await put(configs[2], 6)
+    await checkpointer.amark_interrupt(interrupted)
+    await put(configs[2], 7)
+    await checkpointer.amark_interrupt(configs[3])
+    latest = await put(configs[5], 8)
+    settings = RetentionSettings(
+        keep_last=1, keep_interrupts=True, min_age_seconds=0, batch_pause_seconds=0
+    )
+
+    result = await compact_checkpoints(get_pg_pool(), settings)
+
+    assert result.deleted == 6
+    reader = PostgresCheckpoint(VersionedCheckpointSerializer("zlib"))
+    assert [t.config async for t in reader.alist(thread)] == [latest, interrupted]
+    assert (await reader.aget_tuple(interrupted)).metadata["interrupt"] is True
+
+
+async def test_reads_need_no_connection_of_their_own(
+    pool, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Reads and writes all go through the application's asyncpg pool."""
+
+    async def no_psycopg(*args, **kwargs):
+        raise AssertionError("Opened a psycopg connection.")
+
+    monkeypatch.setattr(psycopg.AsyncConnection, "connect", no_psycopg)
+    checkpointer = PostgresCheckpoint(VersionedCheckpointSerializer("zlib"))
+    checkpoint = _checkpoint(_messages(2))
+    config = await checkpointer.aput(
+        {"configurable": {"thread_id": "pooled"}}, checkpoint
+    )
+
+    # More concurrent reads than the pool has connections.
+    saved = await asyncio.gather(
+        *(checkpointer.aget_tuple(config) for _ in range(pool.get_max_size() * 2))
+    )
+
+    assert all(t.checkpoint == checkpoint for t in saved)
+    assert [t.config async for t in checkpointer.alist(config)] == [config]
+
+
+def test_lru_cache_bounds() -> None:
+    cache = LRUCache(max_entries=3, max_bytes=100)
+    cache.put("a", 1, 40)
+    cache.put("b", 2, 40)
+    assert cache.get("a") == 1
+
+    cache.put("c", 3, 40)
+
+    assert "b" not in cache
+    assert cache.size == 80
+    cache.put("d", 4, 10)
+    cache.put("e", 5, 10)
+    assert "a" not in cache
+    assert len(cache) == 3
+    cache.put("f", 6, 1000)
+    assert cache.get("f") is None
+    assert cache.stats() == {"entries": 3, "bytes": 60, "hits": 1, "misses": 1}
+
+
+@pytest.mark.parametrize("message_store", [False, True])
+async def test_list_pages_through_delta_history(message_store: bool) -> None:
+    checkpointer = PostgresCheckpoint(
+        VersionedCheckpointSerializer("zlib"),
+        storage_mode="delta",
+        snapshot_interval=3,
+        message_store=message_store,
+    )
+    messages = _messages(8)
+    config = {"configurable": {"thread_id": f"t-{message_store}"}}
+    for i in range(1, len(messages) + 1):
+        checkpoint = _checkpoint(messages[:i])
+        checkpoint["ts"] = datetime(
+            2024, 1, 1, 0, 0, i, tzinfo=timezone.utc
+        ).isoformat()
+        config = await checkpointer.aput(
+            config, checkpoint, {"source": "loop", "step": i, "writes": None}
+        )
+
+    history = [t async for t in checkpointer.alist(config)]
+    pages = []
+    before = None
+    while page := [t async for t in checkpointer.alist(config, before=before, limit=3)]:
+        pages.extend(page)
+        before = page[-1].config
+
+    lengths = [len(t.checkpoint["channel_values"]["__root__"]) for t in history]
+    assert lengths == [8, 7, 6, 5, 4, 3, 2, 1]
+    assert pages == history
+    assert [t.metadata["step"] for t in history] == [8, 7, 6, 5, 4, 3, 2, 1]
+    summaries = await checkpointer.alist_summaries(config, limit=2)
+    assert [s.message_count for s in summaries] == [8, 7]
+    assert [s.thread_ts.isoformat() for s in summaries] == [
+        t.config["configurable"]["thread_ts"] for t in history[:2]
+    ]
+    filtered = await checkpointer.alist_summaries(config, metadata_filter={"step": 3})
+    assert [s.message_count for s in filtered] == [3]
+
+
+async def _count_rows(thread_id: str) -> int:
+    async with get_pg_pool().acquire() as conn:
+        return await conn.fetchval(
+            "SELECT count(*) FROM checkpoints WHERE thread_id = $1", thread_id
+        )
+
+
+@pytest.mark.parametrize("message_store", [False, True])
+async def test_write_behind_reads_see_queued_checkpoints(message_store: bool) -> None:
+    checkpointer = PostgresCheckpoint(
+        VersionedCheckpointSerializer("zlib"),
+        storage_mode="delta",
+        write_behind=True,
+        flush_interval=3600,
+        message_store=message_store,
+    )
+    messages = _messages(4)
+    config = {"configurable": {"thread_id": "write-behind"}}
+    configs = []
+    for i in range(1, len(messages) + 1):
+        checkpoint = _checkpoint(messages[:i])
+        checkpoint["ts"] = datetime(
+            2024, 1, 1, 0, 0, i, tzinfo=timezone.utc
+        ).isoformat()
+        config = await checkpointer.aput(config, checkpoint)
+        configs.append(config)
+
+    assert await _count_rows("write-behind") == 0
+    latest = await checkpointer.aget_tuple(
+        {"configurable": {"thread_id": "write-behind"}}
+    )
+    assert latest.config == config
+    assert latest.checkpoint["channel_values"]["__root__"] == messages
+
+    # As on shutdown, every thread.
+    await checkpointer.aflush()
+
+    assert await _count_rows("write-behind") == 4
+    reader = PostgresCheckpoint(VersionedCheckpointSerializer("zlib"))
+    assert await reader.aget_tuple(config) == latest
+    history = [t async for t in reader.alist(config)]
+    assert [t.config for t in history] == configs[::-1]
+
+
+async def test_write_behind_requeues_failed_flushes(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    checkpointer = PostgresCheckpoint(
+        VersionedCheckpointSerializer("zlib"),
+        storage_mode="delta",
+        write_behind=True,
+        flush_interval=3600,
+    )
+    config = {"configurable": {"thread_id": "write-behind-failure"}}
+    first = await checkpointer.aput(config, _checkpoint(_messages(1)))
+
+    def unavailable():
+        raise ConnectionError("database unavailable")
+
+    monkeypatch.setattr("app.checkpoint.get_pg_pool", unavailable)
+    with pytest.raises(ConnectionError):
+        await checkpointer.aflush()
+    monkeypatch.undo()
+    # Queued after the failed flush, as a delta of the requeued checkpoint.
+    checkpoint = _checkpoint(_messages(2))
+    second = await checkpointer.aput(first, checkpoint)
+
+    assert (await checkpointer.aget_tuple(config)).config == second
+    await checkpointer.aflush()
+
+    assert await _count_rows("write-behind-failure") == 2
+    reader = PostgresCheckpoint(VersionedCheckpointSerializer("zlib"))
+    assert (await reader.aget_tuple(config)).checkpoint == checkpoint
+    assert (await reader.aget_tuple(first)).checkpoint["channel_values"][
+        "__root__"
+    ] == _messages(1)
+
+
+async def test_monthly_partitions() -> None:
+    settings = PartitionSettings(monthly=True, months_ahead=1)
+    created, _ = await manage_partitions(get_pg_pool(), settings)
+    assert len(created) == 16
+    assert await manage_partitions(get_pg_pool(), settings) == ([], [])
+
+    checkpointer = PostgresCheckpoint(VersionedCheckpointSerializer("zlib"))
+    config = {"configurable": {"thread_id": "next-month"}}
+    checkpoint = _checkpoint(_messages(2))
+    next_month = datetime.now(timezone.utc).replace(day=28) + timedelta(days=5)
+    checkpoint["ts"] = next_month.isoformat()
+    await checkpointer.aput(config, checkpoint)
+
+    async with get_pg_pool().acquire() as conn:
+        partition = await conn.fetchval(
+            "SELECT tableoid::regclass::text FROM checkpoints WHERE thread_id = $1",
+            "next-month",
+        )
+    assert partition in created
+    assert (await checkpointer.aget_tuple(config)).checkpoint == checkpoint
+
+
+async def _create_month_partitions(month: date) -> list[str]:
+    """Create the partitions of a past month, which the job never does."""
+    names = []
+    async with get_pg_pool().acquire() as conn:
+        for parent in {row["parent"] for row in await conn.fetch(_PARTITIONS_SQL)}:
+            name = _month_partition(parent, month)
+            await conn.execute(
+                f'CREATE TABLE "{name}" PARTITION OF "{parent}" '
+                f"FOR VALUES FROM ('{month.isoformat()}+00') "
+                f"TO ('{_add_months(month, 1).isoformat()}+00')"
+            )
+            names.append(name)
+    return names
+
+
+@pytest.mark.parametrize("message_store", [False, True])
+async def test_retire_month_keeps_later_checkpoints_readable(
+    message_store: bool,
+) -> None:
+    january = await _create_month_partitions(date(2024, 1, 1))
+    checkpointer = PostgresCheckpoint(
+        VersionedCheckpointSerializer("zlib"),
+        storage_mode="delta",
+        snapshot_interval=10,
+        message_store=message_store,
+    )
+    thread_id = f"spanning-{message_store}"
+    config = {"configurable": {"thread_id": thread_id}}
+    start = datetime(2024, 1, 31, 23, 59, 57, tzinfo=timezone.utc)
+    configs, checkpoints = [], []
+    for i in range(6):
+        checkpoint = _checkpoint(_messages(i + 1))
+        checkpoint["ts"] = (start + timedelta(seconds=i)).isoformat()
+        config = await checkpointer.aput(config, checkpoint)
+        configs.append(config)
+        checkpoints.append(checkpoint)
+
+    settings = PartitionSettings(
+        monthly=True, months_ahead=1, retain_months=1, drop_retired=True
+    )
+    _, retired = await manage_partitions(get_pg_pool(), settings, checkpointer)
+
+    assert sorted(retired) == sorted(january)
+    async with get_pg_pool().acquire() as conn:
+        rows = await conn.fetch(
+            "SELECT is_snapshot FROM checkpoints WHERE thread_id = $1 "
+            "ORDER BY thread_ts",
+            thread_id,
+        )
+    assert [row["is_snapshot"] for row in rows] == [True, False, False]
+    reader = PostgresCheckpoint(
+        VersionedCheckpointSerializer("zlib"), message_store=message_store
+    )
+    for config in configs[:3]:
+        assert await reader.aget_tuple(config) is None
+    for config, checkpoint in zip(configs[3:], checkpoints[3:]):
+        assert (await reader.aget_tuple(config)).checkpoint == checkpoint
+    history = [
+        t async for t in reader.alist({"configurable": {"thread_id": thread_id}})
+    ]
+    assert [t.checkpoint for t in history] == checkpoints[:2:-1]
+
+
+async def test_retire_month_keeps_what_forks_refer_to() -> None:
+    january = await _create_month_partitions(date(2024, 1, 1))
+    checkpointer = PostgresCheckpoint(VersionedCheckpointSerializer("zlib"))
+    checkpoint = _checkpoint(_messages(2))
+    checkpoint["ts"] = datetime(2024, 1, 15, tzinfo=timezone.utc).isoformat()
+    source = await checkpointer.aput(
+        {"configurable": {"thread_id": "source"}}, checkpoint
+    )
+    fork = await checkpointer.afork(source, "fork")
+
+    settings = PartitionSettings(
+        monthly=True, months_ahead=1, retain_months=1, drop_retired=True
+    )
+    _, retired = await manage_partitions(get_pg_pool(), settings, checkpointer)
+
+    async with get_pg_pool().acquire() as conn:
+        partition = await conn.fetchval(
+            "SELECT tableoid::regclass::text FROM checkpoints WHERE thread_id = $1",
+            "source",
+        )
+    assert sorted(retired) == sorted(set(january) - {partition})
+    assert (await checkpointer.aget_tuple(fork)).checkpoint == checkpoint
+
+
+async def test_archive_and_restore_thread() -> None:
+    checkpointer = PostgresCheckpoint(
+        VersionedCheckpointSerializer("zlib"), storage_mode="delta", snapshot_interval=3
+    )
+    config = {"configurable": {"thread_id": "idle"}}
+    for i in range(1, 6):
+        checkpoint = _checkpoint(_messages(i))
+        checkpoint["ts"] = datetime(
+            2024, 1, 1, 0, 0, i, tzinfo=timezone.utc
+        ).isoformat()
+        config = await checkpointer.aput(config, checkpoint, {"step": i})
+    history = [t async for t in checkpointer.alist(config)]
+
+    assert await checkpointer.aarchive_thread("idle", datetime.now(timezone.utc)) == 4
+
+    async with get_pg_pool().acquire() as conn:
+        hot = await conn.fetch(
+            "SELECT is_snapshot FROM checkpoints WHERE thread_id = $1", "idle"
+        )
+    assert [row["is_snapshot"] for row in hot] == [True]
+    assert (await checkpointer.aget_tuple(config)) == history[0]
+    assert [t async for t in checkpointer.alist(config)] == history
+
+
+@pytest.mark.parametrize("storage_mode", ["full", "delta"])
+async def test_fork_thread(storage_mode: str) -> None:
+    checkpointer = PostgresCheckpoint(
+        VersionedCheckpointSerializer("zlib"),
+        storage_mode=storage_mode,
+        snapshot_interval=3,
+    )
+    config = {"configurable": {"thread_id": f"source-{storage_mode}"}}
+    for i in range(1, 5):
+        checkpoint = _checkpoint(_messages(i))
+        checkpoint["ts"] = datetime(
+            2024, 1, 1, 0, 0, i, tzinfo=timezone.utc
+        ).isoformat()
+        config = await checkpointer.aput(config, checkpoint, {"step": i})
+    history = [t async for t in checkpointer.alist(config)]
+
+    fork = await checkpointer.afork(history[1].config, f"fork-{storage_mode}")
+
+    forked = await checkpointer.aget_tuple(
+        {"configurable": {"thread_id": f"fork-{storage_mode}"}}
+    )
+    assert forked.config == fork
+    assert forked.checkpoint == history[1].checkpoint
+    assert forked.metadata["forked_from"] == history[1].config["configurable"]
+    checkpoint = _checkpoint(_messages(5))
+    await checkpointer.aput(fork, checkpoint, {"step": 4})
+    forked_history = [t async for t in checkpointer.alist(fork)]
+    assert [t.checkpoint for t in forked_history] == [
+        checkpoint,
+        history[1].checkpoint,
+    ]
+    async with get_pg_pool().acquire() as conn:
+        size = await conn.fetchval(
+            "SELECT length(checkpoint) FROM checkpoints WHERE thread_id = $1 "
+            "AND source_thread_id IS NOT NULL",
+            f"fork-{storage_mode}",
+        )
+    assert size == 0
+    with pytest.raises(ValueError):
+        await checkpointer.afork({"configurable": {"thread_id": "missing"}}, "x")
+
+
+async def test_collect_garbage_of_deleted_threads() -> None:
+    pool = get_pg_pool()
+    # Garbage collection deletes rows behind the checkpointer's back.
+    checkpointer = PostgresCheckpoint(
+        VersionedCheckpointSerializer("zlib"), message_store=True, validate_cache=True
+    )
+    user, _ = await storage.get_or_create_user("gc")
+    user_id = user["user_id"]
+    assistant = await storage.put_assistant(
+        user_id,
+        str(uuid4()),
+        name="assistant",
+        config={"configurable": {"type": "agent"}},
+    )
+    configs = {}
+    for name in ("deleted", "forked", "kept"):
+        thread_id = str(uuid4())
+        await storage.put_thread(
+            user_id, thread_id, assistant_id=assistant["assistant_id"], name=name
+        )
+        configs[name] = await checkpointer.aput(
+            {"configurable": {"thread_id": thread_id}}, _checkpoint(_messages(2))
+        )
+    fork_id = str(uuid4())
+    await storage.put_thread(
+        user_id, fork_id, assistant_id=assistant["assistant_id"], name="fork"
+    )
+    fork = await checkpointer.afork(configs["forked"], fork_id)
+    orphan = {"configurable": {"thread_id": "orphan"}}
+    await checkpointer.aput(orphan, _checkpoint(_messages(2)))
+
+    for name in ("deleted", "forked"):
+        await storage.delete_thread(user_id, configs[name]["configurable"]["thread_id"])
+    settings = GCSettings(batch_rows=1, batch_pause_seconds=0, min_orphan_age_seconds=0)
+    entries, deleted = await collect_garbage(pool, settings)
+
+    assert entries == 1
+    assert deleted == 1 + 2  # The checkpoint and messages of "deleted".
+    assert await checkpointer.aget_tuple(configs["deleted"]) is None
+    forked = await checkpointer.aget_tuple(fork)
+    assert forked.checkpoint["channel_values"]["__root__"] == _messages(2)
+    assert await checkpointer.aget_tuple(configs["kept"]) is not None
+    # The entry of "forked" stays queued until its fork is gone too, which
+    # the next pass sees at the latest.
+    await storage.delete_thread(user_id, fork_id)
+    await collect_garbage(pool, settings)
+    assert await checkpointer.aget_tuple(fork) is None
+    await collect_garbage(pool, settings)
+    assert await checkpointer.aget_tuple(configs["forked"]) is None
+    async with pool.acquire() as conn:
+        assert await conn.fetchval("SELECT count(*) FROM gc_queue") == 0
+    # "orphan" was never queued, having no thread to begin with.
+    assert await queue_orphans(pool, settings) == 1
+    await collect_garbage(pool, settings)
+    assert await checkpointer.aget_tuple(orphan) is None
+
+
+async def test_sweep_messages_no_checkpoint_refers_to() -> None:
+    checkpointer = PostgresCheckpoint(
+        VersionedCheckpointSerializer("zlib"), message_store=True
+    )
+    config = {"configurable": {"thread_id": "swept"}}
+    for i in range(1, 5):
+        checkpoint = _checkpoint([HumanMessage(content=f"version {i}", id="h")])
+        checkpoint["ts"] = datetime(
+            2024, 1, 1, 0, 0, i, tzinfo=timezone.utc
+        ).isoformat()
+        config = await checkpointer.aput(config, checkpoint, {"step": i})
+    async with get_pg_pool().acquire() as conn:
+        # As compaction does, leaving the message of the first one behind.
+        await conn.execute(
+            "DELETE FROM checkpoints WHERE thread_id = $1 AND thread_ts = $2",
+            "swept",
+            datetime(2024, 1, 1, 0, 0, 1, tzinfo=timezone.utc),
+        )
+    assert await checkpointer.aarchive_thread("swept", datetime.now(timezone.utc)) == 2
+    checkpointer.cache.clear()
+    history = [t async for t in checkpointer.alist(config)]
+    settings = GCSettings(batch_pause_seconds=0, sweep_idle_seconds=0)
+    before = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    assert await checkpointer.aprune_messages("swept", before) == 0
+    threads, deleted = await sweep_messages(get_pg_pool(), checkpointer, settings)
+
+    assert threads >= 1 and deleted >= 1
+
+    async with get_pg_pool().acquire() as conn:
+        stored = await conn.fetchval(
+            "SELECT count(*) FROM checkpoint_messages WHERE thread_id = $1", "swept"
+        )
+    assert stored == 3
+    checkpointer.cache.clear()
+    assert [t async for t in checkpointer.alist(config)] == history
+    assert (await checkpointer.aget_tuple(config)).checkpoint["channel_values"][
+        "__root__"
+    ] == [HumanMessage(content="version 4", id="h")]
@@ -0,0 +1,193 @@
+"""Test streaming runs as server-sent events."""
+
+import asyncio
+from itertools import cycle
+
+import orjson
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage
+from langgraph.graph.message import MessageGraph
+
+import app.storage as storage
+from app.auth.handlers import get_auth_handler
+from app.auth.settings import AuthType
+from app.auth.settings import settings as auth_settings
+from app.stream import RunStream, astream_state, coalesce, get_run_stream, to_sse
+from tests.unit_tests.app.helpers import get_client
+
+
+def _graph():
+    model = GenericFakeChatModel(messages=cycle([AIMessage(content="one two three")]))
+    workflow = MessageGraph()
+    workflow.add_node("model", model)
+    workflow.set_entry_point("model")
+    workflow.set_finish_point("model")
+    return workflow.compile()
+
+
+async def _events(deltas: bool, window: float = 0) -> list[tuple[str, object]]:
+    stream = astream_state(
+        _graph(), [HumanMessage(content="hi", id="h")], {}, deltas=deltas
+    )
+    if window:
+        stream = coalesce(stream, window)
+    return [
+        (event["event"], orjson.loads(event["data"]) if "data" in event else None)
+        async for event in to_sse(stream)
+    ]
+
+
+async def test_stream_deltas() -> None:
+    events = await _events(deltas=True)
+
+    deltas = [data for event, data in events if event == "delta"]
+    assert "".join(d["content"] for d in deltas) == "one two three"
+    assert len({d["id"] for d in deltas}) == 1
+    assert [event for event, _ in events if event != "delta"] == [
+        "metadata",
+        "data",
+        "data",
+        "end",
+    ]
+    assert events[-2][1][0]["content"] == "one two three"
+
+
+async def test_stream_accumulated_messages() -> None:
+    events = await _events(deltas=False)
+
+    contents = [data[0]["content"] for event, data in events if event == "data"]
+    assert "delta" not in [event for event, _ in events]
+    # The input, every token, then the complete message.
+    assert contents == [
+        "hi",
+        "one",
+        "one ",
+        "one two",
+        "one two ",
+        "one two three",
+        "one two three",
+    ]
+
+
+async def test_coalesce_sse_events() -> None:
+    events = await _events(deltas=True, window=1)
+
+    assert [event for event, _ in events] == [
+        "metadata",
+        "data",
+        "delta",
+        "data",
+        "end",
+    ]
+    assert events[2][1]["content"] == "one two three"
+
+
+async def _tokens():
+    yield "run"
+    for token in "abc":
+        yield AIMessageChunk(content=token, id="m")
+    await asyncio.sleep(0.1)
+    yield AIMessageChunk(content="d", id="m")
+    yield AIMessageChunk(content="e", id="other")
+    yield [AIMessage(content="abcd", id="m")]
+
+
+async def test_coalesce_windows() -> None:
+    def contents(items: list) -> list:
+        return [
+            item
+            if isinstance(item, str)
+            else [m.content for m in item]
+            if isinstance(item, list)
+            else item.content
+            for item in items
+        ]
+
+    by_time = [item async for item in coalesce(_tokens(), 0.05)]
+    assert contents(by_time) == ["run", "abc", "d", "e", ["abcd"]]
+    by_size = [item async for item in coalesce(_tokens(), 1, max_bytes=2)]
+    assert contents(by_size) == ["run", "ab", "cd", "e", ["abcd"]]
+
+    async def partial_messages():
+        for i in range(1, 5):
+            yield [AIMessageChunk(content="x" * i, id="m")]
+
+    latest = [item async for item in coalesce(partial_messages(), 1, max_bytes=3)]
+    assert [item[0].content for item in latest] == ["xxx", "xxxx"]
+
+
+async def test_resume_run_stream() -> None:
+    release = asyncio.Event()
+
+    async def events():
+        for i in range(3):
+            yield {"event": "data", "data": str(i)}
+        await release.wait()
+        yield {"event": "end"}
+
+    run_stream = RunStream("run", "user", events(), max_events=3)
+    assert get_run_stream("run") is run_stream
+    received = []
+    async for event in run_stream.subscribe():
+        received.append(event)
+        if len(received) == 2:
+            break  # The connection dropped.
+    release.set()
+
+    resumed = [event async for event in run_stream.subscribe(2)]
+    assert [e["id"] for e in received + resumed] == ["1", "2", "3", "4"]
+    assert [e["event"] for e in resumed] == ["data", "end"]
+    assert run_stream.done
+    expired = [event async for event in run_stream.subscribe(0)]
+    assert orjson.loads(expired[0]["data"])["status_code"] == 410
+    assert expired[-1] == {"event": "end"}
+
+
+async def test_resume_finished_run_past_the_end() -> None:
+    async def events():
+        yield {"event": "data", "data": "0"}
+        yield {"event": "end"}
+
+    run_stream = RunStream("finished", "user", events())
+    assert [e["id"] async for e in run_stream.subscribe()] == ["1", "2"]
+
+    resumed = run_stream.subscribe(10)
+    assert await asyncio.wait_for(_drain(resumed), timeout=1) == []
+
+
+async def _drain(events) -> list:
+    return [event async for event in events]
+
+
+async def test_resume_endpoint_event_ids() -> None:
+    get_auth_handler.cache_clear()
+    auth_settings.auth_type = AuthType.NOOP
+    user, _ = await storage.get_or_create_user("1")
+
+    async def events():
+        yield {"event": "data", "data": "0"}
+        yield {"event": "end"}
+
+    run_stream = RunStream("resumed", user["user_id"], events())
+    await _drain(run_stream.subscribe())
+    async with get_client() as client:
+
+        async def resume(last_event_id: str):
+            return await client.get(
+                "/runs/resumed/stream",
+                headers={
+                    "Cookie": "opengpts_user_id=1",
+                    "Last-Event-ID": last_event_id,
+                },
+            )
+
+        assert (await resume("x")).status_code == 400
+        # Out of range ids are clamped to the events there are.
+        for last_event_id, ids in (("-1", ["1", "2"]), ("1", ["2"]), ("5", [])):
+            response = await resume(last_event_id)
+            assert response.status_code == 200
+            assert [
+                line.removeprefix("id: ")
+                for line in response.text.splitlines()
+                if line.startswith("id: ")
+            ] == ids
@@ -5,6 +5,7 @@ import subprocess
 import asyncpg
 import pytest
 
+import app.storage as storage
 from app.auth.settings import AuthType
 from app.auth.settings import settings as auth_settings
 from app.lifespan import get_pg_pool, lifespan
@@ -79,6 +80,8 @@ async def clear_test_db(pool):
         $$;
         """
         await conn.execute(query)
+    # Don't wait for the TRUNCATE notifications.
+    storage.clear_caches()
 
 
 @pytest.fixture(scope="session")